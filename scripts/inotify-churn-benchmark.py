@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import pyinotify
+import inotify_sync_asyncio as controller
+
+TREE_MARKER = ".churn-tree"
+
+def default_root():
+    # tmpfs keeps the benchmark about the watchers, not the disk
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/inotify-churn"
+    return os.path.join(tempfile.gettempdir(), "inotify-churn")
+
+def tree_dirs(root, shape, num_dirs, depth):
+    # 'wide': two levels with a fanout of about sqrt(num_dirs).
+    # 'deep': chains of depth levels, num_dirs / depth of them.
+    dirs = []
+    if shape == "wide":
+        fanout = max(1, int(num_dirs ** 0.5))
+        for i in range(num_dirs):
+            dirs.append(os.path.join(root, f"w{i // fanout}", f"d{i}"))
+    else:
+        chains = max(1, num_dirs // depth)
+        for i in range(num_dirs):
+            chain, level = divmod(i, depth)
+            if chain >= chains:
+                chain, level = i % chains, depth + i // chains
+            dirs.append(os.path.join(root, f"c{chain}", *[f"l{n}" for n in range(level + 1)]))
+    return dirs
+
+def build_part(dirs, files_per_dir):
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+        for n in range(files_per_dir):
+            os.close(os.open(os.path.join(path, f"f{n}"), os.O_CREAT | os.O_WRONLY, 0o644))
+    return len(dirs)
+
+def build_tree(root, shape, num_dirs, files_per_dir, depth, procs):
+    # Reuses a tree built with the same parameters, building millions of
+    # files takes longer than the benchmark itself
+    params = f"{shape} {num_dirs} {files_per_dir} {depth}\n"
+    marker = os.path.join(root, TREE_MARKER)
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if f.read() == params:
+                return tree_dirs(os.path.join(root, "tree"), shape, num_dirs, depth), 0.0
+        shutil.rmtree(root)
+    start = time.time()
+    dirs = tree_dirs(os.path.join(root, "tree"), shape, num_dirs, depth)
+    parts = [dirs[i::procs] for i in range(procs)]
+    with multiprocessing.Pool(procs) as pool:
+        pool.starmap(build_part, [(part, files_per_dir) for part in parts])
+    with open(marker, "w") as f:
+        f.write(params)
+    return dirs, time.time() - start
+
+def churn_worker(worker, dirs, duration, rate, burst, append_size, paths_file, seed):
+    # Generates churn in the tree until duration is over and writes every
+    # path it touched to paths_file. Operations: bursty uploads, renames of
+    # files and of whole directories, deletes and appends to a large file.
+    rng = random.Random(seed)
+    touched = set()
+    own = []
+    serial = 0
+    ops = 0
+    big = os.path.join(rng.choice(dirs), f"churn{worker}-large.bin")
+    deadline = time.time() + duration
+    next_op = time.time()
+    while time.time() < deadline:
+        if rate:
+            next_op += 1 / rate
+            delay = next_op - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        choice = rng.random()
+        try:
+            if choice < 0.5 or not own:
+                d = rng.choice(dirs)
+                for _ in range(rng.randint(1, burst)):
+                    path = os.path.join(d, f"churn{worker}-{serial}")
+                    serial += 1
+                    with open(path, "wb") as f:
+                        f.write(b"x" * rng.randint(0, 4096))
+                    own.append(path)
+                    touched.add(path)
+            elif choice < 0.65:
+                old = own.pop(rng.randrange(len(own)))
+                new = os.path.join(rng.choice(dirs), f"churn{worker}-{serial}")
+                serial += 1
+                os.rename(old, new)
+                own.append(new)
+                touched.update((old, new))
+            elif choice < 0.7:
+                d = os.path.join(rng.choice(dirs), f"churn{worker}-dir{serial}")
+                serial += 1
+                os.mkdir(d)
+                for n in range(rng.randint(1, burst)):
+                    with open(os.path.join(d, f"f{n}"), "wb") as f:
+                        f.write(b"x")
+                moved = os.path.join(rng.choice(dirs), f"churn{worker}-dir{serial}")
+                serial += 1
+                os.rename(d, moved)
+                own.append(moved)
+                touched.update((d, moved))
+            elif choice < 0.85:
+                path = own.pop(rng.randrange(len(own)))
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+                touched.add(path)
+            else:
+                with open(big, "ab") as f:
+                    f.write(b"x" * append_size)
+                touched.add(big)
+        except OSError:
+            continue
+        ops += 1
+    with open(paths_file, "w") as f:
+        f.write("\n".join(sorted(touched)))
+    # The churn files are removed after the run, outside of the measurement
+    with open(paths_file + ".own", "w") as f:
+        f.write("\n".join(own + [big]))
+    return ops
+
+class EventStats:
+    # Sink for all watchers; put_nowait makes it usable as the queue of
+    # ChangeEventHandler
+    def __init__(self):
+        self.events = 0
+        self.batches = 0
+        self.overflows = 0
+        self.paths = set()
+        self.last = time.time()
+
+    def add(self, events):
+        self.batches += 1
+        self.last = time.time()
+        for mask, cookie, path in events:
+            if mask & controller.IN_Q_OVERFLOW:
+                self.overflows += 1
+                continue
+            self.events += 1
+            self.paths.add(path)
+
+    put_nowait = add
+
+def rss_kib():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+
+def inotify_slab_bytes():
+    # Kernel memory of inotify watches; /proc/slabinfo is readable by root only
+    try:
+        with open("/proc/slabinfo") as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == "inotify_inode_mark":
+                    return int(fields[1]) * int(fields[3])
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+def read_sysctl(name):
+    try:
+        with open(f"/proc/sys/fs/inotify/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def register(backend, roots):
+    # Returns (watcher, number of watches or None for fanotify)
+    if backend == "native":
+        watcher = controller.NativeInotify(controller.WATCH_MASK)
+        controller.add_include_watches(watcher, roots, controller.WATCH_MASK)
+        return watcher, len(watcher.wds)
+    if backend == "pyinotify":
+        wm = pyinotify.WatchManager()
+        controller.add_include_watches(wm, roots, controller.WATCH_MASK)
+        return wm, len(wm.watches)
+    return controller.FanotifyWatcher(roots, controller.WATCH_MASK), None
+
+def start_churn(dirs, args, run_dir):
+    ctx = multiprocessing.get_context("fork")
+    pool = ctx.Pool(args.churn_procs)
+    jobs = [(w, dirs, args.duration, args.rate, args.burst, args.append_size,
+             os.path.join(run_dir, f"worker{w}.paths"), args.seed + w) for w in range(args.churn_procs)]
+    return pool, pool.starmap_async(churn_worker, jobs)
+
+def drained(stats, quiet):
+    return time.time() - stats.last >= quiet
+
+async def watch_async(backend, watcher, stats, dirs, args, run_dir):
+    loop = asyncio.get_running_loop()
+    if backend == "pyinotify":
+        handler = controller.ChangeEventHandler(stats)
+        notifier = pyinotify.AsyncioNotifier(watcher, loop, default_proc_fun=handler)
+    else:
+        watcher.start_async(loop, stats.add)
+    pool, result = start_churn(dirs, args, run_dir)
+    start = time.time()
+    while not result.ready():
+        await asyncio.sleep(0.2)
+    churn_time = time.time() - start
+    events_during_churn = stats.events
+    deadline = time.time() + args.drain_timeout
+    while not drained(stats, 1.0) and time.time() < deadline:
+        await asyncio.sleep(0.2)
+    if backend == "pyinotify":
+        notifier.stop()
+    else:
+        watcher.stop()
+    pool.close()
+    pool.join()
+    return sum(result.get()), churn_time, events_during_churn
+
+def watch_thread(backend, watcher, stats, dirs, args, run_dir):
+    if backend == "pyinotify":
+        handler = controller.ChangeEventHandler(stats)
+        notifier = pyinotify.ThreadedNotifier(watcher, handler)
+        notifier.start()
+    else:
+        watcher.start_thread(stats.add)
+    pool, result = start_churn(dirs, args, run_dir)
+    start = time.time()
+    result.wait()
+    churn_time = time.time() - start
+    events_during_churn = stats.events
+    deadline = time.time() + args.drain_timeout
+    while not drained(stats, 1.0) and time.time() < deadline:
+        time.sleep(0.2)
+    if backend == "pyinotify":
+        notifier.stop()
+    else:
+        watcher.stop()
+    pool.close()
+    pool.join()
+    return sum(result.get()), churn_time, events_during_churn
+
+def cleanup_churn(run_dir):
+    for name in os.listdir(run_dir):
+        if not name.endswith(".own"):
+            continue
+        with open(os.path.join(run_dir, name)) as f:
+            for path in f.read().split("\n"):
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif path:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+
+def run_benchmark(backend, mode, dirs, args):
+    tree = os.path.join(args.root, "tree")
+    run_dir = tempfile.mkdtemp(prefix=f"churn-{backend}-{mode}-")
+    stats = EventStats()
+    rss_before = rss_kib()
+    slab_before = inotify_slab_bytes()
+    start = time.time()
+    try:
+        watcher, watches = register(backend, [tree])
+    except OSError as e:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        return {"error": str(e)}
+    registration_time = time.time() - start
+    cold = len(watcher.cold) if backend == "native" else 0
+    rss_after = rss_kib()
+    slab_after = inotify_slab_bytes()
+
+    if mode == "async":
+        ops, churn_time, events_during_churn = asyncio.run(watch_async(backend, watcher, stats, dirs, args, run_dir))
+    else:
+        ops, churn_time, events_during_churn = watch_thread(backend, watcher, stats, dirs, args, run_dir)
+
+    touched = set()
+    for name in os.listdir(run_dir):
+        if name.endswith(".paths"):
+            with open(os.path.join(run_dir, name)) as f:
+                touched.update(p for p in f.read().split("\n") if p)
+    missed = len(touched - stats.paths)
+    cleanup_churn(run_dir)
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+    results = {
+        "watches": watches,
+        "registration_time": registration_time,
+        "rss_per_watch": (rss_after - rss_before) * 1024 / watches if watches else None,
+        "kernel_per_watch": (slab_after - slab_before) / watches if watches and slab_before is not None else None,
+        "operations": ops,
+        "churn_time": churn_time,
+        "events": stats.events,
+        "events_per_second": events_during_churn / churn_time if churn_time else 0,
+        "batches": stats.batches,
+        "overflows": stats.overflows,
+        "touched": len(touched),
+        "missed": missed,
+    }
+    if cold:
+        results["cold"] = cold
+    return results
+
+def run_in_child(conn, backend, mode, dirs, args):
+    try:
+        conn.send(run_benchmark(backend, mode, dirs, args))
+    except Exception as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+    conn.close()
+
+def run_isolated(backend, mode, dirs, args):
+    # Every run gets a fresh process, so memory, file descriptors and
+    # threads of a previous run do not skew the next one
+    ctx = multiprocessing.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=run_in_child, args=(child, backend, mode, dirs, args))
+    process.start()
+    child.close()
+    try:
+        results = parent.recv()
+    except EOFError:
+        results = {"error": f"benchmark process exited with status {process.exitcode}"}
+    process.join()
+    return results
+
+def print_results(backend, mode, results):
+    print(f"\n{backend} ({mode}):")
+    if "error" in results:
+        print(f"skipped: {results['error']}")
+        return
+    if results["watches"] is None:
+        print(f"registration: {results['registration_time']:.3f} seconds (filesystem mark, no per-directory watches)")
+    else:
+        cold = f", {results['cold']} polled" if results.get("cold") else ""
+        print(f"registration: {results['watches']} watches{cold} in {results['registration_time']:.3f} seconds"
+              f" ({results['watches'] / max(results['registration_time'], 1e-9):.0f} watches/s)")
+        rss = results["rss_per_watch"]
+        kernel = results["kernel_per_watch"]
+        print(f"memory per watched directory: {rss:.0f} bytes RSS, "
+              + (f"{kernel:.0f} bytes kernel" if kernel is not None else "kernel n/a (needs root for /proc/slabinfo)"))
+    print(f"churn: {results['operations']} operations in {results['churn_time']:.2f} seconds")
+    print(f"events: {results['events']} in {results['batches']} batches, {results['events_per_second']:.0f} events/s sustained")
+    print(f"overflows: {results['overflows']}, touched paths without an event: {results['missed']} of {results['touched']}"
+          + (" (including changes in polled directories)" if results.get("cold") else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the file watchers of inotify_sync_asyncio.py under synthetic churn')
+    parser.add_argument('--root', type=str, default=default_root(),
+                        help=f'Directory for the test tree, ideally on tmpfs (default: {default_root()})')
+    parser.add_argument('--shape', choices=['wide', 'deep'], default='wide',
+                        help='Directory shape: two wide levels or deep chains (default: wide)')
+    parser.add_argument('--dirs', type=int, default=10000,
+                        help='Number of directories in the tree (default: 10,000)')
+    parser.add_argument('--files-per-dir', type=int, default=10,
+                        help='Number of files per directory (default: 10)')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='Chain depth of the deep shape (default: 8)')
+    parser.add_argument('--build-procs', type=int, default=os.cpu_count() or 1,
+                        help='Processes building the tree (default: number of CPUs)')
+    parser.add_argument('--backends', type=str, default='native,pyinotify,fanotify',
+                        help='Comma separated watcher backends (default: native,pyinotify,fanotify)')
+    parser.add_argument('--modes', type=str, default='async,thread',
+                        help='Comma separated execution modes (default: async,thread)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds of churn per run (default: 10)')
+    parser.add_argument('--churn-procs', type=int, default=4,
+                        help='Processes generating churn (default: 4)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Operations per second per churn process, 0 for as fast as possible (default: 0)')
+    parser.add_argument('--burst', type=int, default=20,
+                        help='Maximum files per upload burst (default: 20)')
+    parser.add_argument('--append-size', type=int, default=64 * 1024,
+                        help='Bytes per append to the large file of each churn process (default: 65536)')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='Maximum seconds to wait for the watcher to catch up after the churn (default: 60)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed of the churn (default: 1)')
+    parser.add_argument('--max-watches', type=int, default=0,
+                        help='Watch budget of the native backend, 0 for 90%% of max_user_watches (default: 0)')
+    parser.add_argument('--keep-tree', action='store_true',
+                        help='Keep the test tree for the next run')
+    args = parser.parse_args()
+
+    # Overflows and vanished directories are counted, not logged
+    controller.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("pyinotify").setLevel(logging.CRITICAL)
+    controller.max_watches = args.max_watches
+
+    print(f"Building {args.shape} tree of {args.dirs} directories with {args.files_per_dir} files each in {args.root}")
+    dirs, build_time = build_tree(args.root, args.shape, args.dirs, args.files_per_dir, args.depth, args.build_procs)
+    print("Reusing existing tree." if not build_time else f"Built in {build_time:.2f} seconds.")
+    print(f"fs.inotify.max_user_watches: {read_sysctl('max_user_watches')}, "
+          f"max_queued_events: {read_sysctl('max_queued_events')}")
+
+    results = {}
+    try:
+        for backend in args.backends.split(','):
+            for mode in args.modes.split(','):
+                results[(backend, mode)] = run_isolated(backend, mode, dirs, args)
+                print_results(backend, mode, results[(backend, mode)])
+    finally:
+        if not args.keep_tree:
+            shutil.rmtree(args.root, ignore_errors=True)
+
+    watched = [r for r in results.values() if r.get("watches")]
+    if watched:
+        needed = max(r["watches"] + r.get("cold", 0) for r in watched)
+        kernel = [r["kernel_per_watch"] for r in watched if r["kernel_per_watch"]]
+        print(f"\nSizing: {needed} watched directories need fs.inotify.max_user_watches >= {int(needed / 0.9) + 1}"
+              f" for the default 90% watch budget"
+              + (f", about {needed * max(kernel) / 2 ** 20:.1f} MiB of kernel memory" if kernel else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import contextlib
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (script, arguments). Journal, snapshot index and SSH pool are
+# disabled and full syncs pushed out so only the replayed events cause work.
+CONTROLLERS = {
+    'asyncio': ('inotify_sync_asyncio.py', ['--disable-journal', '--disable-snapshot', '--disable-ssh-pool',
+                                            '--full-sync-interval', '86400']),
+    'asyncio-thread': ('inotify_sync_asyncio.py', ['--mode', 'thread', '--disable-journal', '--disable-snapshot',
+                                                   '--disable-ssh-pool', '--full-sync-interval', '86400']),
+    'parallel': ('inotify_sync_parallel.py', ['--full-sync-interval', '86400']),
+    'sync': ('inotify_sync.py', []),
+}
+
+# Stand-in for csync2 and rsync. Every call is appended to BENCH_STUB_LOG
+# as one JSON line with its arguments, the paths rsync read from stdin and
+# its start and end time. The csync2 server (-ii) just sleeps.
+STUB = r'''#!{python}
+import json, os, sys, time
+start = time.time()
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+if tool == "csync2" and "-ii" in args:
+    while True:
+        time.sleep(3600)
+stdin_paths = []
+if tool == "rsync" and "--files-from=-" in args:
+    source = args[-2]
+    stdin_paths = [os.path.normpath(os.path.join(source, os.fsdecode(p)))
+                   for p in sys.stdin.buffer.read().split(b"\0") if p]
+paths = [a for a in args if a.startswith("/")] + stdin_paths
+time.sleep(float(os.environ.get("BENCH_STUB_LATENCY", "0")) +
+           float(os.environ.get("BENCH_STUB_PATH_LATENCY", "0")) * len(paths))
+if os.environ.get("BENCH_STUB_OUTPUT") == "verbose":
+    for path in paths:
+        if tool == "rsync":
+            print(f">f+++++++++ {{path}}")
+        elif "-cr" in args or "-x" in args:
+            print(f"Marking file as dirty: {{path}}", file=sys.stderr)
+record = {{"tool": tool, "args": args, "stdin": stdin_paths, "start": start, "end": time.time(),
+          "argv_bytes": sum(len(os.fsencode(a)) + 1 for a in sys.argv)}}
+fd = os.open(os.environ["BENCH_STUB_LOG"], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+os.write(fd, (json.dumps(record) + "\n").encode())
+os.close(fd)
+'''
+
+def decode_path(path):
+    # Same escaping as the event journal of inotify_sync_asyncio.py
+    path = os.fsdecode(path)
+    if '\\' in path:
+        path = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), path)
+    return path
+
+def read_trace(trace_path):
+    # [(delay in seconds, mask, cookie, "<include index>/<relative path>")]
+    events = []
+    with gzip.open(trace_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            delta_us, mask, cookie, path = line[:-1].split(b' ', 3)
+            events.append((int(delta_us) / 1e6, int(mask), int(cookie), decode_path(path)))
+    return events
+
+def generate_trace(num_events, num_dirs=20, burst=50, seed=1):
+    # Synthetic trace: bursts of uploads into a few directories, with
+    # rewrites, renames and deletes of earlier files between them
+    rng = random.Random(seed)
+    events, files = [], []
+    dirs = [f"0/site{i % 5}/dir{i}" for i in range(num_dirs)]
+    for d in dirs:
+        events.append((0.0, IN_CREATE | IN_ISDIR, 0, d))
+    cookie = serial = 1
+    while len(events) < num_events:
+        delay = rng.expovariate(1 / 0.5)
+        d = rng.choice(dirs)
+        for i in range(rng.randint(1, burst)):
+            choice = rng.random()
+            if choice < 0.6 or not files:
+                path = f"{d}/upload{serial}.dat"
+                serial += 1
+                files.append(path)
+                events += [(delay, IN_CREATE, 0, path), (0.0, IN_CLOSE_WRITE, 0, path)]
+            elif choice < 0.8:
+                events.append((delay, IN_CLOSE_WRITE, 0, rng.choice(files)))
+            elif choice < 0.9:
+                old = files.pop(rng.randrange(len(files)))
+                new = f"{rng.choice(dirs)}/renamed{cookie}.dat"
+                files.append(new)
+                events += [(delay, IN_MOVED_FROM, cookie, old), (0.0, IN_MOVED_TO, cookie, new)]
+                cookie += 1
+            else:
+                events.append((delay, IN_DELETE, 0, files.pop(rng.randrange(len(files)))))
+            delay = 0.0
+    return events[:num_events]
+
+def trace_roots(events):
+    return sorted({int(path.split('/', 1)[0]) for _, _, _, path in events})
+
+def replay(events, roots, speed):
+    # Applies the traced operations to the tree. Returns the operations as
+    # (time, absolute path) and the number that could not be applied.
+    ops = []
+    errors = 0
+    moves = {}
+    start = time.time()
+    offset = 0.0
+    for delay, mask, cookie, path in events:
+        offset += delay
+        if speed:
+            wait = start + offset / speed - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        index, _, relative = path.partition('/')
+        target = os.path.join(roots[int(index)], relative) if relative else roots[int(index)]
+        try:
+            if mask & IN_MOVED_FROM:
+                moves[cookie] = target
+                continue
+            if mask & IN_MOVED_TO and cookie in moves:
+                source = moves.pop(cookie)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.rename(source, target)
+                ops.append((time.time(), source))
+            elif mask & IN_DELETE:
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                else:
+                    os.unlink(target)
+            elif mask & IN_ISDIR:
+                os.makedirs(target, exist_ok=True)
+            elif mask & IN_ATTRIB and os.path.exists(target):
+                os.utime(target)
+            elif mask & (IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'ab') as f:
+                    if not mask & IN_CREATE:
+                        f.write(b'x' * 64)
+            else:
+                continue
+        except OSError:
+            errors += 1
+            continue
+        ops.append((time.time(), target))
+    # Rename sources whose destination is outside the traced tree are gone
+    for source in moves.values():
+        try:
+            if os.path.isdir(source):
+                shutil.rmtree(source)
+            else:
+                os.unlink(source)
+            ops.append((time.time(), source))
+        except OSError:
+            errors += 1
+    return ops, errors
+
+def read_calls(log_path):
+    calls = []
+    if not os.path.exists(log_path):
+        return calls
+    with open(log_path) as f:
+        for line in f:
+            try:
+                call = json.loads(line)
+            except ValueError:
+                continue
+            call['paths'] = {os.path.normpath(a) for a in call['args'] if a.startswith('/')} | set(call['stdin'])
+            calls.append(call)
+    calls.sort(key=lambda call: call['start'])
+    return calls
+
+def call_kind(call, nodes):
+    # ('check' | 'push' | 'sync', nodes the call replicates to)
+    args = call['args']
+    if call['tool'] == 'rsync':
+        host = args[-1].split(':', 1)[0] if args else ''
+        return 'sync', [host]
+    if '-x' in args:
+        return 'sync', nodes
+    if any(a.startswith('-u') for a in args):
+        return 'push', [args[args.index('-P') + 1]] if '-P' in args else nodes
+    if any(a.startswith('-c') for a in args):
+        return 'check', []
+    return 'other', []
+
+def ancestors(path):
+    result = [path]
+    while True:
+        path = os.path.dirname(path)
+        if path in ('/', ''):
+            return result
+        result.append(path)
+
+def replication_latencies(ops, calls, nodes):
+    # An operation counts as replicated once every node received a push
+    # that started after a check (or an rsync / csync2 -x transfer)
+    # covering the path or one of its parent directories
+    kinds = [call_kind(call, nodes) for call in calls]
+    starts = [call['start'] for call in calls]
+    pushes = {node: [(call['start'], call['end']) for call, (kind, targets) in zip(calls, kinds)
+                     if kind == 'push' and node in targets] for node in nodes}
+    push_starts = {node: [start for start, _ in pushes[node]] for node in nodes}
+    latencies = {}
+    for t_op, path in ops:
+        covering = set(ancestors(path))
+        done = {}
+        for i in range(bisect.bisect_left(starts, t_op), len(calls)):
+            kind, targets = kinds[i]
+            if kind == 'other' or not covering & calls[i]['paths']:
+                continue
+            if kind == 'check':
+                for node in nodes:
+                    j = bisect.bisect_left(push_starts[node], calls[i]['end'])
+                    if node not in done and j < len(pushes[node]):
+                        done[node] = pushes[node][j][1]
+            else:
+                for node in targets:
+                    done.setdefault(node, calls[i]['end'])
+            if len(done) == len(nodes):
+                break
+        if len(done) == len(nodes):
+            latencies[(t_op, path)] = max(done.values()) - t_op
+    return latencies
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def process_usage(pid):
+    # CPU seconds and peak RSS in KiB of the controller process itself,
+    # without the stand-in commands it started
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        with open(f"/proc/{pid}/status") as f:
+            rss = next((int(line.split()[1]) for line in f if line.startswith('VmHWM:')), 0)
+        return cpu, rss
+    except (OSError, StopIteration):
+        return float('nan'), 0
+
+def write_config(path, nodes, roots):
+    # Flat "key value" lines without a group block or semicolons are read
+    # the same way by all three controllers
+    with open(path, 'w') as f:
+        for node in nodes:
+            f.write(f"host {node}\n")
+        for root in roots:
+            f.write(f"include {root}\n")
+
+def wait_for_calls(log_path, quiet_period, timeout):
+    # Waits until the stand-ins were not called for quiet_period seconds
+    deadline = time.time() + timeout
+    last_size, last_change = -1, time.time()
+    while time.time() < deadline:
+        size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        if size != last_size:
+            last_size, last_change = size, time.time()
+        elif time.time() - last_change >= quiet_period:
+            return True
+        time.sleep(0.2)
+    return False
+
+def run_benchmark(name, events, speed, args):
+    script, controller_args = CONTROLLERS[name]
+    work = tempfile.mkdtemp(prefix=f"replay-{name}-", dir=args.work_dir)
+    bin_dir = os.path.join(work, 'bin')
+    os.makedirs(bin_dir)
+    for tool in ('csync2', 'rsync'):
+        stub = os.path.join(bin_dir, tool)
+        with open(stub, 'w') as f:
+            f.write(STUB.format(python=sys.executable))
+        os.chmod(stub, 0o755)
+    roots = [os.path.join(work, 'tree', str(i)) for i in range(max(trace_roots(events)) + 1)]
+    for root in roots:
+        os.makedirs(root)
+    nodes = args.nodes.split(',')
+    config = os.path.join(work, 'csync2.cfg')
+    write_config(config, nodes, roots)
+    log_path = os.path.join(work, 'calls.log')
+    env = dict(os.environ, PATH=f"{bin_dir}:{os.environ.get('PATH', '')}", BENCH_STUB_LOG=log_path,
+               BENCH_STUB_LATENCY=str(args.stub_latency), BENCH_STUB_PATH_LATENCY=str(args.stub_path_latency),
+               BENCH_STUB_OUTPUT=args.stub_output)
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, script), '--config', config, *controller_args, *args.controller_args]
+
+    with open(os.path.join(work, 'controller.log'), 'w') as output:
+        controller = subprocess.Popen(cmd, env=env, stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+        try:
+            # Startup work (initial full sync, catch-up) finishes before the replay
+            time.sleep(args.settle)
+            wait_for_calls(log_path, args.settle, args.drain_timeout)
+            startup_calls = len(read_calls(log_path))
+            replay_start = time.time()
+            ops, errors = replay(events, roots, None if speed == 'max' else float(speed))
+            replay_time = time.time() - replay_start
+            drained = wait_for_calls(log_path, args.quiet_period, args.drain_timeout)
+            exited = controller.poll()
+            cpu, rss = process_usage(controller.pid)
+        finally:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(controller.pid, signal.SIGINT)
+            try:
+                controller.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(controller.pid, signal.SIGKILL)
+            controller.wait()
+
+    calls = read_calls(log_path)[startup_calls:]
+    # A controller whose processing thread died keeps running, its log
+    # shows the traceback
+    with open(os.path.join(work, 'controller.log'), errors='replace') as f:
+        crashed = 'Traceback (most recent call last)' in f.read()
+    if not calls:
+        failed = "no csync2 or rsync calls during the replay"
+    elif exited is not None:
+        failed = f"controller exited with status {exited}"
+    elif crashed:
+        failed = "controller logged a traceback"
+    else:
+        failed = None
+    latencies = replication_latencies(ops, calls, nodes)
+    # Paths whose final state exists but never reached every node
+    final = {}
+    for op in ops:
+        final[op[1]] = op
+    missed = sum(1 for path, op in final.items() if op not in latencies and os.path.lexists(path))
+    values = list(latencies.values())
+    counts = {}
+    for call in calls:
+        kind = call_kind(call, nodes)[0]
+        counts[kind] = counts.get(kind, 0) + 1
+    if not args.keep:
+        shutil.rmtree(work, ignore_errors=True)
+    return {
+        'failed': failed,
+        'operations': len(ops),
+        'replay_errors': errors,
+        'replay_time': replay_time,
+        'replicated': len(values),
+        'missed': missed,
+        'drained': drained,
+        'exited': exited,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else float('nan'),
+        'subprocesses': len(calls),
+        'calls': counts,
+        'argv_bytes': sum(call['argv_bytes'] for call in calls),
+        'cpu_seconds': cpu,
+        'peak_rss_kib': rss,
+        'work_dir': work,
+    }
+
+def seconds(value, sign=''):
+    return "n/a" if value != value else f"{value:{sign}.3f}s"
+
+def print_results(name, speed, results, keep=False):
+    print(f"\n{name} @ {speed}{'x' if speed != 'max' else ''}:")
+    print(f"operations: {results['operations']} replayed in {results['replay_time']:.2f} seconds"
+          f" ({results['replay_errors']} could not be applied)")
+    print(f"replicated: {results['replicated']}, final states never pushed: {results['missed']}"
+          + ("" if results['drained'] else " (still busy at drain timeout)"))
+    if results['failed']:
+        print(f"FAILED: {results['failed']}" + (", see controller.log" if keep else ", rerun with --keep for controller.log"))
+    print(f"event->push latency: p50 {seconds(results['p50'])}, p90 {seconds(results['p90'])},"
+          f" p99 {seconds(results['p99'])}, max {seconds(results['max'])}")
+    calls = ', '.join(f"{kind}={count}" for kind, count in sorted(results['calls'].items()))
+    print(f"subprocesses: {results['subprocesses']} ({calls}), argv bytes: {results['argv_bytes']}")
+    print(f"controller CPU: {results['cpu_seconds']:.2f} seconds, peak RSS: {results['peak_rss_kib'] / 1024:.1f} MiB")
+    if keep:
+        print(f"work directory: {results['work_dir']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay an inotify event trace into the csync2 controllers')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Trace recorded with inotify_sync_asyncio.py --record-trace (default: synthetic trace)')
+    parser.add_argument('--synthetic-events', type=int, default=2000,
+                        help='Number of events in the synthetic trace (default: 2000)')
+    parser.add_argument('--controllers', type=str, default=','.join(CONTROLLERS),
+                        help=f"Comma separated controllers to run (default: {','.join(CONTROLLERS)})")
+    parser.add_argument('--speeds', type=str, default='1,10,max',
+                        help='Comma separated replay speeds, a factor or max (default: 1,10,max)')
+    parser.add_argument('--nodes', type=str, default='n1,n2',
+                        help='Comma separated peer names written to the config (default: n1,n2)')
+    parser.add_argument('--stub-latency', type=float, default=0.05,
+                        help='Seconds every csync2/rsync stand-in call takes (default: 0.05)')
+    parser.add_argument('--stub-path-latency', type=float, default=0.0001,
+                        help='Additional seconds per path argument (default: 0.0001)')
+    parser.add_argument('--stub-output', choices=['quiet', 'verbose'], default='quiet',
+                        help='Print a csync2/rsync style line per path from the stand-ins (default: quiet)')
+    parser.add_argument('--settle', type=float, default=3,
+                        help='Seconds to wait after startup before the replay (default: 3)')
+    parser.add_argument('--quiet-period', type=float, default=12,
+                        help='Seconds without stand-in calls after which a run is finished (default: 12)')
+    parser.add_argument('--drain-timeout', type=float, default=300,
+                        help='Maximum seconds to wait for a controller to finish (default: 300)')
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='Directory for the replay trees, ideally a tmpfs (default: system temp dir)')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the replay trees, stand-in call logs and controller logs')
+    args, controller_args = parser.parse_known_args()
+    args.controller_args = controller_args
+
+    if args.trace:
+        events = read_trace(args.trace)
+        print(f"Replaying {len(events)} events from {args.trace}")
+    else:
+        events = generate_trace(args.synthetic_events)
+        print(f"Replaying a synthetic trace of {len(events)} events")
+    if not events:
+        print("Error: the trace is empty.")
+        sys.exit(1)
+    # The controllers keep their queue and log files here
+    os.makedirs("/home/csync2-inotify/tmp", exist_ok=True)
+
+    results = {}
+    for name in args.controllers.split(','):
+        if name not in CONTROLLERS:
+            print(f"Unknown controller {name}, skipping it.")
+            continue
+        for speed in args.speeds.split(','):
+            result = run_benchmark(name, events, speed, args)
+            print_results(name, speed, result, args.keep)
+            results[(name, speed)] = result
+
+    names = [name for name in args.controllers.split(',') if name in CONTROLLERS]
+    if len(names) > 1:
+        print(f"\nComparison against {names[0]} (p50 latency, CPU):")
+        for speed in args.speeds.split(','):
+            base = results[(names[0], speed)]
+            for name in names[1:]:
+                other = results[(name, speed)]
+                if base['failed'] or other['failed']:
+                    print(f"{name} @ {speed}: skipped, {names[0] if base['failed'] else name} failed")
+                    continue
+                print(f"{name} @ {speed}: p50 {seconds(other['p50'] - base['p50'], '+')},"
+                      f" CPU {other['cpu_seconds'] - base['cpu_seconds']:+.2f}s,"
+                      f" subprocesses {other['subprocesses'] - base['subprocesses']:+d}")
+
+if __name__ == "__main__":
+    main()
@@ -149,9 +149,12 @@ def main(csync_opts, debug=False):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Csync2 controller')
+    parser.add_argument('--config', type=str, default="/etc/csync2/csync2.cfg", help='Path to csync2 config file')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
     args, csync_opts = parser.parse_known_args()
 
+    config_file = args.config
+
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
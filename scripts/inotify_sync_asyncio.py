@@ -2,34 +2,106 @@
 
 import os
 import queue
+import random
 import threading
 import subprocess
 import time
 import signal
 import logging
 import argparse
+import array
+import bisect
 import concurrent.futures
+import collections
+import contextlib
 import pyinotify
 import asyncio
 import sys
 import traceback
+import ctypes
+import ctypes.util
+import errno
+import gzip
+import heapq
+import http.server
+import math
+import re
+import select
+import shlex
+import socketserver
+import sqlite3
+import stat
+import struct
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 queue_file = "/home/csync2-inotify/tmp/inotify_queue_python.log"
 csync_log_file = "/home/csync2-inotify/tmp/csync_server_python.log"
+dead_letter_file = "/home/csync2-inotify/tmp/csync_dead_letter.log"
+snapshot_file = "/home/csync2-inotify/tmp/inotify_snapshot.db"
 check_interval = 0.5
 full_sync_interval = 3600
+full_sync_budget = 5.0
+shard_files = 1000
 num_lines_until_reset = 200000
 num_batched_changes_threshold = 15000
 rsync_threshold = 5000
-parallel_updates = 1
+parallel_updates = 4
+per_node_updates = 1
 max_wait_time = 10
+min_quiet_time = 0.05
+max_quiet_time = 2.0
+max_pending = 10000
+rate_window = 1.0
+quiet_rate_scale = 10.0
 last_full_sync = 0
 queue_line_pos = 1
 config_file = "/etc/csync2/csync2.cfg"
 use_rsync = False
+rsync_mode = "files"
+rsync_options = []
+rsync_node_options = {}
+ssh_command = ["ssh"]
+ssh_control_dir = "/home/csync2-inotify/tmp/ssh"
+ssh_idle_timeout = 600
+ssh_connect_timeout = 10
+use_ssh_pool = True
+ssh_pool = None
+trace_file = None
+trace_recorder = None
+metrics_listen = ""
+metrics_server = None
+collapse_min_children = 200
+collapse_ratio = 0.5
+max_argv_bytes = 0
+use_journal = True
+journal_sync_interval = 0.05
+journal_compact_bytes = 64 * 1024 * 1024
+event_journal = None
+use_snapshot = True
+scan_workers = 8
+snapshot = None
+max_node_lag = 8
+node_retry_delay = 5
+replication = None
+latency_tracker = None
+latency_report_interval = 60
+max_latency_paths = 1000000
+limiter = None
+server_idle_timeout = 30
+server_monitor = None
+max_output_records = 1000
+sync_stats = collections.Counter()
+retry_max_attempts = 5
+retry_base_delay = 2.0
+retry_max_delay = 300
+retries = None
+rescans = None
+watcher_backend = "native"
+native_read_size = 256 * 1024
+max_watches = 0
+cold_poll_interval = 60
 
 # Global flag for graceful shutdown
 shutdown_flag = False
@@ -60,128 +132,3102 @@ def initialize_environment():
         logger.error(f"Configuration file not found: {config_file}")
         raise FileNotFoundError(f"Configuration file not found: {config_file}")
 
+def glob_to_regex(pattern, star):
+    # fnmatch-style translation; star is what '*' may match, '.*' for
+    # patterns compared against the full path and '[^/]*' for patterns
+    # compared against a single path component
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            out.append(star)
+        elif c == '?':
+            out.append('.' if star == '.*' else '[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                out.append('\\[')
+                continue
+            body = pattern[i:j].replace('\\', '\\\\')
+            if body[:1] == '!':
+                body = '^' + body[1:]
+            out.append(f'[{body}]')
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+class ExcludeMatcher:
+    # Compiles all csync2.cfg exclude patterns into one regex. Patterns
+    # starting with '/' are matched against the full path (and everything
+    # below it), other patterns against each path component, so anything
+    # under an excluded directory name is excluded as well.
+    def __init__(self, patterns):
+        full, component = [], []
+        for value in patterns:
+            for pattern in value.split():
+                pattern = pattern.strip('"')
+                if not pattern:
+                    continue
+                if pattern.startswith('/'):
+                    full.append(glob_to_regex(pattern.rstrip('/') or '/', '.*'))
+                else:
+                    component.append(glob_to_regex(pattern, '[^/]*'))
+        alternatives = []
+        if full:
+            alternatives.append('^(?:' + '|'.join(full) + ')(?:/|$)')
+        if component:
+            alternatives.append('(?:^|/)(?:' + '|'.join(component) + ')(?:/|$)')
+        self.count = len(full) + len(component)
+        self._search = re.compile('|'.join(alternatives), re.S).search if alternatives else None
+
+    def __bool__(self):
+        return self._search is not None
+
+    def __call__(self, path):
+        return self._search is not None and self._search(path) is not None
+
+exclude_matcher = ExcludeMatcher([])
+
 class ChangeEventHandler(pyinotify.ProcessEvent):
-    def __init__(self, queue):
+    def __init__(self, queue, exclude_filter=None):
         self.queue = queue
+        self.exclude_filter = exclude_filter
 
     def process_default(self, event):
+        if self.exclude_filter and self.exclude_filter(event.pathname):
+            return
         logger.debug(f"Detected event: {event.maskname} on {event.pathname}")
-        # Add to the queue in a non-async way
-        self.queue.put_nowait(event.pathname)
+        # Add to the queue in a non-async way, as a one-event batch so both
+        # watcher backends feed the queue the same way
+        self.queue.put_nowait(((event.mask, getattr(event, 'cookie', 0) or 0, event.pathname),))
 
     process_IN_CREATE = process_IN_DELETE = process_IN_MODIFY = process_default
     process_IN_CLOSE_WRITE = process_IN_MOVED_FROM = process_IN_MOVED_TO = process_default
     process_IN_ATTRIB = process_default
 
-def csync_server_wait():
-    attempts = 0
-    max_attempts = 60
-    while attempts < max_attempts and not shutdown_flag:
-        if not os.path.exists(csync_log_file) or os.path.getsize(csync_log_file) == 0:
-            break
-        time.sleep(0.5)
-        attempts += 1
-        logger.debug(f"Waiting for csync server... Attempt {attempts}/{max_attempts}")
-    else:
-        logger.warning("Csync server wait timeout reached")
+    def process_IN_Q_OVERFLOW(self, event):
+        logger.warning("Inotify event queue overflowed, events were lost")
+        self.queue.put_nowait(((IN_Q_OVERFLOW, 0, ''),))
+
+    def process_IN_IGNORED(self, event):
+        self.queue.put_nowait(((IN_IGNORED, 0, event.path),))
+
+# Raw inotify constants from <sys/inotify.h>, used by the native backend
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_DELETE | IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | \
+             IN_MOVED_FROM | IN_MOVED_TO | IN_ATTRIB
+
+# Queue markers for lost events: an overflow (path '', all roots) or a
+# watch the kernel dropped (path of its directory)
+RESCAN_MASK = IN_Q_OVERFLOW | IN_IGNORED
+
+inotify_event_header = struct.Struct('iIII')
+
+def watch_budget():
+    # Watches this process may use: --max-watches, or 90% of the per-user
+    # kernel limit to leave room for other inotify users
+    if max_watches:
+        return max_watches
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as f:
+            limit = int(f.read())
+    except (OSError, ValueError):
+        limit = 8192
+    return int(limit * 0.9)
+
+class NativeInotify:
+    # Minimal inotify watcher talking to the kernel through libc. Events are
+    # read in large buffers and decoded in bulk into a list of
+    # (mask, cookie, pathname) tuples per read, which is handed to the sink
+    # as one batch.
+    def __init__(self, mask=WATCH_MASK, read_size=None, exclude_filter=None):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.mask = mask
+        self.read_size = read_size or native_read_size
+        self.exclude_filter = exclude_filter
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+        self.watches = {}  # wd -> directory path
+        self.wds = {}      # directory path -> wd
+        self.roots = []
+        # Directories beyond the watch budget are polled instead
+        self.budget = watch_budget()
+        self.cold = {}  # directory path -> mtime_ns at the last poll
+        self.last_active = {}  # wd -> time of the last event in it
+        self.promoted = 0
+        self.demoted = 0
+        self.lock = threading.RLock()
+        self._loop = None
+        self._thread = None
+        self._poller = None
+        self._deliver = None
+        self._recovery = None
+        self._overflowed = False
+        self._stopped = False
+
+    def fileno(self):
+        return self.fd
+
+    def _add_one(self, path):
+        # Returns the wd, or None if the directory went to the cold set.
+        # Locked per directory, registration may run beside read_events()
+        with self.lock:
+            if len(self.wds) >= self.budget and path not in self.wds:
+                return self._make_cold(path)
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask | IN_ONLYDIR)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    if self.budget > len(self.wds):
+                        logger.warning(f"Inotify watch limit reached at {len(self.wds)} watches, "
+                                       f"polling further directories every {cold_poll_interval}s")
+                        self.budget = len(self.wds)
+                    return self._make_cold(path)
+                raise OSError(err, f"inotify_add_watch failed for {path}: {os.strerror(err)}")
+            self.watches[wd] = path
+            self.wds[path] = wd
+            self.cold.pop(path, None)
+            return wd
+
+    def _make_cold(self, path):
+        try:
+            self.cold[path] = os.stat(path).st_mtime_ns
+        except OSError as e:
+            # Removed before it could be polled; whatever happened in it
+            # shows in its parent, which is rescanned
+            logger.debug(f"Cannot poll {path}: {e}")
+            self.cold.pop(path, None)
+            if self._deliver is not None:
+                self._deliver([(IN_IGNORED, 0, os.path.dirname(path))])
+        return None
+
+    def _demote(self, path):
+        wd = self.wds.pop(path)
+        self.watches.pop(wd, None)
+        self.last_active.pop(wd, None)
+        self._libc.inotify_rm_watch(self.fd, wd)
+        self._make_cold(path)
+        self.demoted += 1
+
+    def _rebalance(self, changed):
+        # Promote cold directories that changed; when the budget is used
+        # up, each one takes the watch of the least recently active hot
+        # directory, provided that one was idle for a whole poll interval
+        if not changed:
+            return
+        with self.lock:
+            idle_before = time.time() - cold_poll_interval
+            protected = set(self.roots)
+            candidates = [] if len(self.wds) + len(changed) <= self.budget else heapq.nsmallest(
+                len(changed), ((self.last_active.get(wd, 0), path) for path, wd in self.wds.items() if path not in protected))
+            for path in changed:
+                if path not in self.cold:
+                    continue
+                if len(self.wds) >= self.budget:
+                    if not candidates or candidates[0][0] > idle_before:
+                        break
+                    self._demote(candidates.pop(0)[1])
+                try:
+                    if self._add_one(path) is not None:
+                        self.promoted += 1
+                except OSError as e:
+                    logger.debug(f"Cannot promote {path}: {e}")
+            logger.info(f"  Watches: {len(self.wds)} hot, {len(self.cold)} cold, {self.promoted} promoted, {self.demoted} demoted")
+
+    def poll_cold(self, since_ns):
+        # One sweep over the cold set. A changed directory mtime means
+        # entries were added, removed or renamed and the directory is
+        # queued as a whole; otherwise only entries modified since the
+        # previous sweep are queued.
+        events = []
+        changed = []
+        for path, mtime_ns in list(self.cold.items()):
+            try:
+                current = os.stat(path).st_mtime_ns
+            except OSError:
+                self.cold.pop(path, None)
+                continue
+            entries = list_directory(path)[1] or ()
+            if current != mtime_ns:
+                with self.lock:
+                    if path not in self.cold:
+                        continue
+                    self.cold[path] = current
+                    # New subdirectories get a watch or join the cold set
+                    for name, _, _, _, mode in entries:
+                        sub = os.path.join(path, name)
+                        if stat.S_ISDIR(mode) and sub not in self.wds and sub not in self.cold:
+                            try:
+                                self.add_watch(sub)
+                            except OSError as e:
+                                logger.debug(f"Skipping watch on {sub}: {e}")
+                events.append((IN_MODIFY | IN_ISDIR, 0, path))
+                changed.append(path)
+                continue
+            modified = [(IN_MODIFY, 0, os.path.join(path, name))
+                        for name, _, entry_mtime_ns, _, mode in entries
+                        if entry_mtime_ns >= since_ns and not stat.S_ISDIR(mode)]
+            if modified:
+                events += modified
+                changed.append(path)
+        return events, changed
+
+    def run_poller(self, deliver):
+        # Margin for the coarse kernel clock, see add_watches_parallel
+        since_ns = time.time_ns() - 10 ** 9
+        while not self._stopped and not shutdown_flag:
+            deadline = time.time() + cold_poll_interval
+            while time.time() < deadline and not self._stopped and not shutdown_flag:
+                time.sleep(min(1, cold_poll_interval))
+            if not self.cold or self._stopped:
+                continue
+            start_ns = time.time_ns() - 10 ** 9
+            events, changed = self.poll_cold(since_ns)
+            since_ns = start_ns
+            if events:
+                deliver(events)
+            self._rebalance(changed)
+
+    def start_poller(self, deliver):
+        self._deliver = deliver
+        self._poller = threading.Thread(target=self.run_poller, args=(deliver,), name="cold-poll", daemon=True)
+        self._poller.start()
+
+    def add_watch(self, path, mask=None, rec=True, auto_add=True, exclude_filter=None):
+        # Same call shape as pyinotify.WatchManager.add_watch; directories
+        # created later are always auto-added by read_events()
+        path = os.path.normpath(path)
+        if mask is not None:
+            self.mask = mask
+        if exclude_filter is not None:
+            self.exclude_filter = exclude_filter
+        excluded = self.exclude_filter
+        if excluded and excluded(path):
+            return
+        self._add_one(path)
+        if not any(path == r or path.startswith(r + '/') for r in self.roots):
+            self.roots.append(path)
+        if not rec:
+            return
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if excluded and excluded(entry.path):
+                                continue
+                            try:
+                                self._add_one(entry.path)
+                            except OSError as e:
+                                if e.errno == errno.ENOSPC:
+                                    raise
+                                logger.debug(f"Skipping watch on {entry.path}: {e}")
+                                continue
+                            stack.append(entry.path)
+            except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+                logger.debug(f"Skipping directory {current}: {e}")
+
+    def _register(self, paths, since_ns, limit=256):
+        # Registers up to limit directories depth-first and hands the rest
+        # back to be spread over the pool. Watch first, then list: a
+        # subdirectory created in between shows up in the listing or as an
+        # IN_CREATE that read_events() auto-adds.
+        excluded = self.exclude_filter
+        stack = list(paths)
+        changed = []
+        done = 0
+        while stack and done < limit:
+            path = stack.pop()
+            try:
+                self._add_one(path)
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and not (excluded and excluded(entry.path)):
+                            stack.append(entry.path)
+                if os.stat(path).st_mtime_ns >= since_ns:
+                    changed.append(path)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                logger.debug(f"Skipping watch on {path}: {e}")
+            done += 1
+        return stack, changed
+
+    def add_watches_parallel(self, roots, workers):
+        # Bulk registration for startup. Returns catch-up events for the
+        # entries of directories that changed while registration ran, since
+        # their events may have happened before the watch existed.
+        start = time.time()
+        # Timestamps come from the coarse kernel clock, which lags behind
+        since_ns = time.time_ns() - 10 ** 9
+        changed_dirs = []
+        roots = [os.path.normpath(r) for r in roots if not (self.exclude_filter and self.exclude_filter(r))]
+        for root in roots:
+            if not any(root == r or root.startswith(r + '/') for r in self.roots):
+                self.roots.append(root)
+        workers = max(workers, 1)
+        last_report = start
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = {pool.submit(self._register, [root], since_ns) for root in roots}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=5, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        leftover, changed = future.result()
+                    except OSError:
+                        for f in pending:
+                            f.cancel()
+                        raise
+                    changed_dirs += changed
+                    # Split the leftover so idle workers get a share
+                    step = max(len(leftover) // workers, 1)
+                    for i in range(0, len(leftover), step):
+                        pending.add(pool.submit(self._register, leftover[i:i + step], since_ns))
+                now = time.time()
+                if now - last_report >= 5:
+                    logger.info(f"  Registered {len(self.wds)} watches ({len(self.wds) / (now - start):.0f}/s)")
+                    last_report = now
+        events = []
+        for path in changed_dirs:
+            for name, _, mtime_ns, _, mode in list_directory(path)[1] or ():
+                if mtime_ns >= since_ns:
+                    events.append((IN_CREATE | (IN_ISDIR if stat.S_ISDIR(mode) else 0), 0, os.path.join(path, name)))
+        logger.info(f"Watches ready: {len(self.wds)} directories in {time.time() - start:.2f}s"
+                    + (f", {len(self.cold)} polled every {cold_poll_interval}s" if self.cold else "")
+                    + (f", {len(events)} entries changed during registration" if events else ""))
+        return events
+
+    def _forget_prefix(self, prefix):
+        head = prefix + '/'
+        for path in [p for p in self.wds if p == prefix or p.startswith(head)]:
+            wd = self.wds.pop(path)
+            self.watches.pop(wd, None)
+            self.last_active.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+        for path in [p for p in self.cold if p == prefix or p.startswith(head)]:
+            del self.cold[path]
+
+    def _rename_prefix(self, old, new):
+        head = old + '/'
+        for path in [p for p in self.wds if p == old or p.startswith(head)]:
+            wd = self.wds.pop(path)
+            moved = new + path[len(old):]
+            self.watches[wd] = moved
+            self.wds[moved] = wd
+        for path in [p for p in self.cold if p == old or p.startswith(head)]:
+            self.cold[new + path[len(old):]] = self.cold.pop(path)
+
+    def read_events(self, max_reads=16):
+        with self.lock:
+            return self._read_events(max_reads)
+
+    def _read_events(self, max_reads):
+        now = time.time()
+        last_active = self.last_active
+        events = []
+        new_dirs = []
+        moved_dirs = {}
+        overflowed = False
+        watches = self.watches
+        excluded = self.exclude_filter
+        unpack = inotify_event_header.unpack_from
+        header_size = inotify_event_header.size
+        append = events.append
+        for _ in range(max_reads):
+            try:
+                buf = os.read(self.fd, self.read_size)
+            except BlockingIOError:
+                break
+            end = len(buf)
+            offset = 0
+            while offset < end:
+                wd, mask, cookie, name_len = unpack(buf, offset)
+                offset += header_size
+                name = buf[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("Inotify event queue overflowed, events were lost")
+                    append((IN_Q_OVERFLOW, 0, ''))
+                    overflowed = True
+                    continue
+                base = watches.get(wd)
+                if base is None:
+                    continue
+                last_active[wd] = now
+                if mask & IN_IGNORED:
+                    # Watches we remove ourselves are gone from watches
+                    # already; this one was dropped by the kernel
+                    watches.pop(wd, None)
+                    self.wds.pop(base, None)
+                    if os.path.isdir(base):
+                        append((IN_IGNORED, 0, base))
+                        new_dirs.append(base)
+                    continue
+                path = base + '/' + os.fsdecode(name) if name else base
+                if excluded and excluded(path):
+                    continue
+                if mask & IN_ISDIR:
+                    if mask & IN_CREATE:
+                        new_dirs.append(path)
+                    elif mask & IN_MOVED_FROM:
+                        moved_dirs[cookie] = path
+                    elif mask & IN_MOVED_TO:
+                        old = moved_dirs.pop(cookie, None)
+                        if old is not None and old in self.wds:
+                            self._rename_prefix(old, path)
+                        else:
+                            new_dirs.append(path)
+                append((mask, cookie, path))
+            if end < self.read_size // 2:
+                break
+        # Directories moved out of the watched trees keep their kernel
+        # watches unless we drop them here
+        for old in moved_dirs.values():
+            self._forget_prefix(old)
+        if overflowed:
+            # Directories created during the overflow were never auto-added.
+            # Walking the trees again takes long, so it is done in parallel
+            # on a worker thread while events keep being read.
+            self._overflowed = True
+            if self._recovery is None:
+                self._recovery = threading.Thread(target=self._rewatch, name="overflow-rewatch", daemon=True)
+                self._recovery.start()
+            new_dirs = []
+        for path in new_dirs:
+            if path in self.wds:
+                continue
+            try:
+                self.add_watch(path, rec=True)
+            except OSError as e:
+                logger.error(f"Error adding watch for {path}: {e}")
+        return events
+
+    def _rewatch(self):
+        # Re-registers every root after an overflow, again if one more
+        # overflow happened meanwhile
+        while not self._stopped and not shutdown_flag:
+            with self.lock:
+                if not self._overflowed:
+                    self._recovery = None
+                    return
+                self._overflowed = False
+            try:
+                events = self.add_watches_parallel(list(self.roots), scan_workers)
+            except OSError as e:
+                if not self._stopped:
+                    logger.error(f"Error re-adding watches after overflow: {e}")
+                continue
+            if events and self._deliver is not None:
+                self._deliver(events)
+        self._recovery = None
+
+    def start_async(self, loop, sink):
+        self._loop = loop
+
+        def on_readable():
+            events = self.read_events()
+            if events:
+                sink(events)
+
+        loop.add_reader(self.fd, on_readable)
+        self.start_poller(lambda events: loop.call_soon_threadsafe(sink, events))
+
+    def run_thread(self, sink):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        while not self._stopped and not shutdown_flag:
+            if not poller.poll(1000):
+                continue
+            events = self.read_events()
+            if events:
+                sink(events)
+
+    def start_thread(self, sink):
+        self._thread = threading.Thread(target=self.run_thread, args=(sink,), daemon=True)
+        self._thread.start()
+        self.start_poller(sink)
+        return self._thread
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._poller is not None:
+            self._poller.join()
+            self._poller = None
+        if self._loop is not None:
+            self._loop.remove_reader(self.fd)
+            self._loop = None
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+# fanotify constants from <linux/fanotify.h>. The event bits match the
+# inotify ones (FAN_ONDIR is IN_ISDIR), so masks are passed on unchanged.
+FAN_CLOEXEC = 0x00000001
+FAN_NONBLOCK = 0x00000002
+FAN_REPORT_DFID_NAME = 0x00000c00
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_FILESYSTEM = 0x00000100
+FAN_ONDIR = 0x40000000
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+FAN_EVENT_INFO_TYPE_DFID = 3
+AT_FDCWD = -100
+
+fanotify_metadata = struct.Struct('IBBHQii')
+fanotify_info_header = struct.Struct('BBH')
+
+class FanotifyWatcher:
+    # Whole-filesystem watcher: one fanotify mark per filesystem holding an
+    # include, instead of one inotify watch per directory. Mount marks
+    # cannot carry directory entry events, so they are not an option.
+    # Events carry the parent directory as a file handle plus the entry
+    # name; handles are resolved to paths with open_by_handle_at and
+    # cached, and everything outside the include roots is dropped here.
+    # Needs CAP_SYS_ADMIN and Linux 5.9 or later. fanotify has no rename
+    # cookies, so a move arrives as a delete plus a create. Resolved paths
+    # are real paths, so includes behind a symlink are matched by their
+    # real path and events are mapped back to the configured include.
+    def __init__(self, includes, mask=WATCH_MASK, read_size=None, exclude_filter=None):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+        self._libc.open_by_handle_at.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        self.read_size = read_size or native_read_size
+        self.exclude_filter = exclude_filter
+        self.roots = [os.path.normpath(i) for i in includes]
+        self.fd = self._libc.fanotify_init(FAN_CLOEXEC | FAN_NONBLOCK | FAN_REPORT_DFID_NAME, os.O_RDONLY)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"fanotify_init failed: {os.strerror(err)}")
+        self.mount_fds = {}  # fsid -> fd of an include on that filesystem
+        self.handles = {}  # (fsid, handle) -> directory path
+        self._loop = None
+        self._thread = None
+        self._stopped = False
+        mark_flags = FAN_MARK_ADD | FAN_MARK_FILESYSTEM
+        marked = set()
+        self.real_roots = []  # (real path, configured path), longest first
+        for root in self.roots:
+            if not os.path.exists(root):
+                logger.warning(f"Directory does not exist: {root}. Creating it.")
+                os.makedirs(root, exist_ok=True)
+            real = os.path.realpath(root)
+            if real != root:
+                logger.warning(f"Include {root} resolves to {real}, fanotify reports it under that path")
+            self.real_roots.append((real, root))
+            device = os.stat(root).st_dev
+            if device in marked:
+                continue
+            if self._libc.fanotify_mark(self.fd, mark_flags, mask | FAN_ONDIR, AT_FDCWD, os.fsencode(root)) < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, f"fanotify_mark failed for {root}: {os.strerror(err)}")
+            marked.add(device)
+            # statvfs packs the two 32-bit halves of the kernel fsid
+            fsid = struct.pack('II', *divmod(os.statvfs(root).f_fsid, 1 << 32)[::-1])
+            self.mount_fds[fsid] = os.open(root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        self.real_roots.sort(key=lambda r: len(r[0]), reverse=True)
+        logger.info(f"fanotify marks on {len(marked)} filesystem(s) for {len(self.roots)} include(s)")
+
+    def fileno(self):
+        return self.fd
+
+    def _resolve(self, fsid, handle):
+        key = (fsid, handle)
+        path = self.handles.get(key)
+        if path is not None:
+            return path
+        mount_fd = self.mount_fds.get(fsid)
+        if mount_fd is None:
+            return None
+        fd = self._libc.open_by_handle_at(mount_fd, handle, os.O_PATH)
+        if fd < 0:
+            # ESTALE: the directory is gone
+            return None
+        try:
+            path = os.readlink(f"/proc/self/fd/{fd}")
+        finally:
+            os.close(fd)
+        if len(self.handles) > 65536:
+            self.handles.clear()
+        self.handles[key] = path
+        return path
+
+    def _configured(self, path):
+        # The path under its configured include, or None when it is outside
+        # every include or excluded
+        for real, root in self.real_roots:
+            if path == real or path.startswith(real + '/'):
+                path = root + path[len(real):]
+                return None if self.exclude_filter and self.exclude_filter(path) else path
+        return None
+
+    def read_events(self, max_reads=16):
+        events = []
+        append = events.append
+        unpack_meta = fanotify_metadata.unpack_from
+        unpack_info = fanotify_info_header.unpack_from
+        for _ in range(max_reads):
+            try:
+                buf = os.read(self.fd, self.read_size)
+            except BlockingIOError:
+                break
+            end = len(buf)
+            offset = 0
+            while offset < end:
+                event_len, _, _, metadata_len, mask, fd, _ = unpack_meta(buf, offset)
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("fanotify event queue overflowed, events were lost")
+                    append((IN_Q_OVERFLOW, 0, ''))
+                    offset += event_len
+                    continue
+                info = offset + metadata_len
+                path = None
+                while info < offset + event_len:
+                    info_type, _, info_len = unpack_info(buf, info)
+                    if info_type in (FAN_EVENT_INFO_TYPE_DFID_NAME, FAN_EVENT_INFO_TYPE_DFID):
+                        fsid = bytes(buf[info + 4:info + 12])
+                        handle_bytes = struct.unpack_from('I', buf, info + 12)[0]
+                        handle_end = info + 12 + 8 + handle_bytes
+                        directory = self._resolve(fsid, bytes(buf[info + 12:handle_end]))
+                        if directory is not None:
+                            name = b''
+                            if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                                name = buf[handle_end:info + info_len].split(b'\0', 1)[0]
+                            path = directory if name in (b'', b'.') else directory + '/' + os.fsdecode(name)
+                        break
+                    info += info_len
+                offset += event_len
+                if fd >= 0:
+                    os.close(fd)
+                if path is not None:
+                    path = self._configured(path)
+                if path is None:
+                    continue
+                gone = mask & (IN_DELETE | IN_MOVED_FROM)
+                if gone and mask & ~(gone | FAN_ONDIR):
+                    # Events merged into one record lose their order, so the
+                    # entry's current state decides
+                    if os.path.lexists(path):
+                        mask &= ~gone
+                    else:
+                        mask = IN_DELETE | (mask & FAN_ONDIR)
+                if mask & FAN_ONDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.handles.clear()
+                append((mask, 0, path))
+            if end < self.read_size // 2:
+                break
+        return events
+
+    def start_async(self, loop, sink):
+        self._loop = loop
+
+        def on_readable():
+            events = self.read_events()
+            if events:
+                sink(events)
+
+        loop.add_reader(self.fd, on_readable)
+
+    def run_thread(self, sink):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        while not self._stopped and not shutdown_flag:
+            if not poller.poll(1000):
+                continue
+            events = self.read_events()
+            if events:
+                sink(events)
+
+    def start_thread(self, sink):
+        self._thread = threading.Thread(target=self.run_thread, args=(sink,), daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._loop is not None:
+            self._loop.remove_reader(self.fd)
+            self._loop = None
+        for fd in self.mount_fds.values():
+            os.close(fd)
+        self.mount_fds = {}
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+OP_UPSERT = 'upsert'
+OP_DELETE = 'delete'
+OP_RENAME = 'rename'
+
+class EventCoalescer:
+    # Reduces the event history of each path to one final operation between
+    # flushes. Entries are [op, is_dir, created, source, first_seen]:
+    # created marks paths that did not exist before the window, so a later
+    # delete cancels them out, source is the old path of a rename paired by
+    # inotify cookie, and first_seen is the time of the earliest event the
+    # entry stands for. Entries of one batch share a single float.
+    def __init__(self):
+        self.ops = {}
+        self.moves = {}  # cookie -> (old path, is_dir, old entry, first seen)
+
+    def __len__(self):
+        return len(self.ops) + len(self.moves)
+
+    def add_batch(self, events):
+        add = self.add
+        now = time.time()
+        for mask, cookie, path in events:
+            add(mask, cookie, path, now)
+
+    def add(self, mask, cookie, path, now):
+        ops = self.ops
+        is_dir = bool(mask & IN_ISDIR)
+        if mask & IN_MOVED_FROM and cookie:
+            first_seen = self._forget_children(path, is_dir, now)
+            old_entry = ops.pop(path, None)
+            self.moves[cookie] = (path, is_dir, old_entry, min(first_seen, old_entry[4]) if old_entry else first_seen)
+        elif mask & IN_MOVED_TO and cookie in self.moves:
+            old, old_is_dir, old_entry, first_seen = self.moves.pop(cookie)
+            if old_entry is not None and old_entry[2]:
+                ops[path] = [OP_UPSERT, is_dir, True, None, first_seen]
+            elif old_entry is not None and old_entry[0] == OP_RENAME:
+                ops[path] = [OP_RENAME, is_dir, False, old_entry[3], first_seen]
+            else:
+                ops[path] = [OP_RENAME, is_dir, False, old, first_seen]
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            entry = ops.get(path)
+            if entry is None:
+                ops[path] = [OP_UPSERT, is_dir, True, None, now]
+            else:
+                entry[0] = OP_UPSERT
+                entry[1] = is_dir
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._delete(path, is_dir, self._forget_children(path, is_dir, now))
+        elif path not in ops:
+            ops[path] = [OP_UPSERT, is_dir, False, None, now]
+
+    def _delete(self, path, is_dir, now):
+        entry = self.ops.pop(path, None)
+        if entry is None:
+            self.ops[path] = [OP_DELETE, is_dir, False, None, now]
+        elif entry[0] == OP_RENAME:
+            # The renamed file is gone again, so only the original removal
+            # is left to replicate
+            if entry[3] not in self.ops:
+                self.ops[entry[3]] = [OP_DELETE, is_dir, False, None, min(now, entry[4])]
+        elif not entry[2]:
+            self.ops[path] = [OP_DELETE, is_dir, False, None, min(now, entry[4])]
+
+    def _forget_children(self, path, is_dir, now):
+        # A moved or deleted directory is replicated as one subtree
+        # operation, so pending child entries carry no extra information
+        # beyond their first-seen time, which the subtree inherits
+        if not is_dir:
+            return now
+        head = path + '/'
+        for child in [p for p in self.ops if p.startswith(head)]:
+            now = min(now, self.ops.pop(child)[4])
+        return now
+
+    def drain(self):
+        ops = self.ops
+        for old, is_dir, old_entry, first_seen in self.moves.values():
+            # Moved out of the watched trees
+            if old_entry is None or not old_entry[2]:
+                ops[old] = [OP_DELETE, is_dir, False, None, first_seen]
+        self.ops = {}
+        self.moves = {}
+        # Only a created, moved or deleted directory stands for its subtree;
+        # an attribute change keeps the paths below it
+        subtrees = {path for path, entry in ops.items()
+                    if entry[1] and (entry[2] or entry[0] != OP_UPSERT)}
+        if not subtrees:
+            return ops
+        result = {}
+        for path, entry in ops.items():
+            parent = os.path.dirname(path)
+            while parent and parent != '/' and parent not in subtrees:
+                parent = os.path.dirname(parent)
+            if parent not in subtrees:
+                result[path] = entry
+                continue
+            # The outermost subtree covering the path inherits its first-seen
+            # time, nested subtrees are dropped as well
+            top = parent
+            while parent and parent != '/':
+                parent = os.path.dirname(parent)
+                if parent in subtrees:
+                    top = parent
+            ops[top][4] = min(ops[top][4], entry[4])
+        return result
+
+def coalesced_paths(ops):
+    # Rename sources are still handed to csync2 so the removal of the old
+    # name gets recorded and pushed
+    paths = {}
+    for path, entry in ops.items():
+        if entry[0] == OP_RENAME:
+            paths[entry[3]] = None
+        paths[path] = None
+    return list(paths)
+
+class PathTrie:
+    # Nested dicts keyed by path component; the None key marks a pending path
+    def __init__(self, paths=()):
+        self.root = {}
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        node = self.root
+        for part in path.strip('/').split('/'):
+            node = node.setdefault(part, {})
+        node[None] = True
+
+    def collapse(self, includes, min_children, ratio):
+        # Replace the changed children of a directory with the directory
+        # itself once their count or share of the directory passes the
+        # thresholds; csync2 -r then recurses into it. Only directories
+        # without unchanged subdirectories qualify, so a few edits never
+        # recheck a large untouched subtree, and the ratio never collapses
+        # an include root.
+        roots = [os.path.normpath(i) for i in includes]
+        result = []
+        self._collapse(self.root, '', roots, min_children, ratio, result)
+        return result
+
+    @staticmethod
+    def _listing(path, collapsed):
+        # Number of entries, or None when an unchanged subdirectory would
+        # be rechecked along with the directory
+        entries = 0
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    entries += 1
+                    if entry.name not in collapsed and entry.is_dir(follow_symlinks=False):
+                        return None
+        except OSError:
+            # Directory is gone, csync2 picks up the removals recursively
+            return len(collapsed)
+        return entries
+
+    def _collapse(self, node, path, roots, min_children, ratio, result):
+        if None in node:
+            result.append(path or '/')
+            return True
+        start = len(result)
+        collapsed = set()
+        for name, child in node.items():
+            if self._collapse(child, path + '/' + name, roots, min_children, ratio, result):
+                collapsed.add(name)
+        changed = len(collapsed)
+        if changed < 2 or not any(path == r or path.startswith(r + '/') for r in roots):
+            return False
+        by_count = min_children and changed >= min_children
+        if not by_count and (not ratio or path in roots):
+            return False
+        entries = self._listing(path, collapsed)
+        if entries is None or not (by_count or changed >= ratio * entries):
+            return False
+        del result[start:]
+        result.append(path)
+        return True
+
+def collapse_paths(paths, includes):
+    if len(paths) < 2 or not (collapse_min_children or collapse_ratio):
+        return paths
+    collapsed = PathTrie(paths).collapse(includes, collapse_min_children, collapse_ratio)
+    if len(collapsed) < len(paths):
+        logger.debug(f"Collapsed {len(paths)} paths into {len(collapsed)} csync2 arguments")
+    return collapsed
+
+def add_include_watches(wm, includes, mask, exclude_filter=None):
+    # Returns catch-up events for changes made while the watches were
+    # being registered (native backend only)
+    native_roots = []
+    for include_path in includes:
+        try:
+            if not os.path.exists(include_path):
+                logger.warning(f"Directory does not exist: {include_path}. Creating it.")
+                os.makedirs(include_path, exist_ok=True)
+            if isinstance(wm, NativeInotify):
+                native_roots.append(include_path)
+            elif exclude_filter:
+                wm.add_watch(include_path, mask, rec=True, auto_add=True, exclude_filter=exclude_filter)
+            else:
+                wm.add_watch(include_path, mask, rec=True, auto_add=True)
+        except (pyinotify.WatchManagerError, OSError) as e:
+            logger.error(f"Error adding watch for {include_path}: {e}")
+    if not native_roots:
+        return []
+    wm.mask = mask
+    try:
+        return wm.add_watches_parallel(native_roots, scan_workers)
+    except OSError as e:
+        logger.error(f"Error adding watches: {e}")
+        return []
+
+class CsyncServerMonitor:
+    # Drains the stdout of the "csync2 -ii -t" server and tracks whether it is
+    # serving a peer. With -t every connection ends with a TOTALTIME line, so
+    # any other output opens a connection and TOTALTIME closes it. A server
+    # that stays silent for idle_timeout while busy is considered idle again.
+    def __init__(self, idle_timeout=30, threaded=False):
+        self.idle_timeout = idle_timeout
+        self.threaded = threaded
+        self.ready = threading.Event() if threaded else asyncio.Event()
+        self.ready.set()
+        self.active_connections = 0
+        self.connections = 0
+        self.last_activity = time.time()
+        self.busy_since = None
+        self.log_file = None
+
+    def feed(self, line):
+        line = line.decode(errors='replace').rstrip() if isinstance(line, bytes) else line.rstrip()
+        if not line:
+            return
+        self.last_activity = time.time()
+        if self.log_file is not None:
+            self.log_file.write(line + "\n")
+        if 'TOTALTIME' in line:
+            if self.active_connections:
+                self.active_connections -= 1
+                self.connections += 1
+            if not self.active_connections and self.busy_since is not None:
+                logger.debug(f"Csync server idle after {time.time() - self.busy_since:.2f}s busy")
+                self.busy_since = None
+                self.ready.set()
+        else:
+            logger.debug(f"csync2 server: {line}")
+            # The forking -ii server can serve several peers at once; with -v
+            # each new one announces itself
+            if not self.active_connections or 'connection from' in line.lower():
+                self.active_connections += 1
+                if self.busy_since is None:
+                    self.busy_since = time.time()
+                self.ready.clear()
+
+    def _open_log(self):
+        try:
+            self.log_file = open(csync_log_file, 'a', buffering=1)
+        except OSError as e:
+            logger.warning(f"Cannot write csync server log {csync_log_file}: {e}")
+
+    def truncate_log(self):
+        # The log is opened with O_APPEND, so the monitor keeps writing at
+        # the new end of the file
+        if self.log_file is not None:
+            try:
+                os.truncate(csync_log_file, 0)
+            except OSError as e:
+                logger.warning(f"Cannot truncate csync server log {csync_log_file}: {e}")
+
+    def _expire(self):
+        # A peer that died mid-transfer never produces TOTALTIME
+        if not self.ready.is_set() and time.time() - self.last_activity >= self.idle_timeout:
+            logger.warning(f"Csync server silent for {self.idle_timeout}s with {self.active_connections} open connection(s), assuming idle")
+            self.active_connections = 0
+            self.busy_since = None
+            self.ready.set()
+
+    async def run(self, stream):
+        self._open_log()
+        try:
+            while True:
+                line = await stream.readline()
+                if not line:
+                    break
+                self.feed(line)
+        finally:
+            self.stopped()
+
+    def run_thread(self, stream):
+        self._open_log()
+        try:
+            for line in iter(stream.readline, b''):
+                self.feed(line)
+        finally:
+            self.stopped()
+
+    def stopped(self):
+        self.active_connections = 0
+        self.ready.set()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        if not shutdown_flag:
+            logger.error("Csync2 server output closed, server exited")
+
+    async def wait_ready(self):
+        if self.ready.is_set():
+            return
+        start = time.time()
+        logger.debug(f"Waiting for csync server ({self.active_connections} active connection(s))")
+        while not self.ready.is_set() and not shutdown_flag:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout=min(1, self.idle_timeout))
+            except asyncio.TimeoutError:
+                self._expire()
+        logger.debug(f"Csync server ready after {time.time() - start:.2f}s")
+
+    def wait_ready_threaded(self):
+        if self.ready.is_set():
+            return
+        start = time.time()
+        logger.debug(f"Waiting for csync server ({self.active_connections} active connection(s))")
+        while not self.ready.wait(min(1, self.idle_timeout)) and not shutdown_flag:
+            self._expire()
+        logger.debug(f"Csync server ready after {time.time() - start:.2f}s")
+
+class EventJournal:
+    # Append-only write-ahead log of raw events in queue_file, one
+    # "mask cookie path" line per event. Appends are group-committed with a
+    # single fsync per sync interval, and the consumer offset is checkpointed
+    # next to the journal together with the journal's inode, so a compacted
+    # journal is never read with a stale offset. Paths waiting for a retry
+    # are journaled again and hold the checkpoint back until they are
+    # re-queued, so a restart during the backoff does not lose them. Node
+    # pipelines fail paths from their own threads, hence the lock.
+    def __init__(self, path, sync_interval=0.05):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.sync_interval = sync_interval
+        self.file = open(path, 'ab')
+        self.end = self.file.tell()
+        self.acked = 0
+        self.buffer = bytearray()
+        self.last_commit = time.time()
+        self.has_checkpoint = False
+        self.lock = threading.RLock()
+        self.holds = {}  # path -> offset of its retry record
+
+    @staticmethod
+    def _encode(mask, cookie, path):
+        if '\\' in path or '\n' in path:
+            path = path.replace('\\', '\\\\').replace('\n', '\\n')
+        return f"{mask} {cookie} ".encode() + os.fsencode(path) + b'\n'
+
+    @staticmethod
+    def _decode(line):
+        mask, cookie, path = line.split(b' ', 2)
+        path = os.fsdecode(path)
+        if '\\' in path:
+            path = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), path)
+        return int(mask), int(cookie), path
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.offset_path) as f:
+                inode, offset = (int(v) for v in f.read().split())
+        except (OSError, ValueError):
+            return None
+        self.has_checkpoint = True
+        # A different inode means the journal was compacted after this
+        # checkpoint was written, so the whole file is unacknowledged
+        return offset if inode == os.fstat(self.file.fileno()).st_ino else 0
+
+    def _write_checkpoint(self, offset):
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(f"{os.fstat(self.file.fileno()).st_ino} {offset}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+    def replay(self):
+        offset = self._read_checkpoint() or 0
+        offset = min(offset, self.end)
+        self.acked = offset
+        events = []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # A torn final record without its newline is dropped
+        complete = data.rfind(b'\n') + 1
+        for line in data[:complete].splitlines():
+            try:
+                events.append(self._decode(line))
+            except ValueError:
+                logger.warning(f"Skipping corrupt journal record: {line[:200]!r}")
+        if complete < len(data):
+            self.file.truncate(offset + complete)
+            self.end = offset + complete
+        return events
+
+    def append(self, events):
+        encode = self._encode
+        with self.lock:
+            for mask, cookie, path in events:
+                self.buffer += encode(mask, cookie, path)
+        self.maybe_commit()
+
+    def hold(self, paths):
+        with self.lock:
+            for path in paths:
+                if path not in self.holds:
+                    self.holds[path] = self.end + len(self.buffer)
+                    self.buffer += self._encode(IN_MODIFY, 0, path)
+
+    def release(self, paths):
+        with self.lock:
+            for path in paths:
+                self.holds.pop(path, None)
+
+    def maybe_commit(self):
+        if self.buffer and time.time() - self.last_commit >= self.sync_interval:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.buffer:
+                self.file.write(self.buffer)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.end += len(self.buffer)
+                self.buffer.clear()
+            self.last_commit = time.time()
+            return self.end
+
+    def ack(self, offset):
+        # The journal grows by a line per raw event, so it is compacted by
+        # size right after an ack, when no batch offset is outstanding,
+        # rather than waiting for an idle queue reset
+        with self.lock:
+            if self.holds:
+                offset = min(offset, min(self.holds.values()))
+            if offset > self.acked:
+                self.acked = offset
+                self._write_checkpoint(offset)
+                if journal_compact_bytes and self.acked >= journal_compact_bytes:
+                    logger.info(f"Compacting event journal after {self.acked} acknowledged bytes ({self.end - self.acked} pending)")
+                    self.compact()
+
+    def compact(self):
+        # Rewrite the unacknowledged tail into a fresh file and swap it in
+        with self.lock:
+            self.commit()
+            tmp_path = self.path + ".compact"
+            with open(self.path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                src.seek(self.acked)
+                while True:
+                    block = src.read(1024 * 1024)
+                    if not block:
+                        break
+                    dst.write(block)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, self.path)
+            self.file.close()
+            self.file = open(self.path, 'ab')
+            self.end = self.file.tell()
+            self.holds = {path: offset - self.acked for path, offset in self.holds.items()}
+            self.acked = 0
+            self._write_checkpoint(0)
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+def open_journal():
+    global event_journal
+    if use_journal:
+        event_journal = EventJournal(queue_file, journal_sync_interval)
+    return event_journal
+
+def close_journal(event_queue):
+    # Events read by the watcher but not yet consumed are journaled so the
+    # next start replays them
+    if event_journal is None:
+        return
+    while not event_queue.empty():
+        event_journal.append(event_queue.get_nowait())
+    event_journal.close()
+
+class TraceRecorder:
+    # Records the event stream as delivered by the watcher into a gzipped
+    # trace for scripts/inotify-replay-benchmark.py. Each line is
+    # "delta_us mask cookie path" in the journal encoding, with the time
+    # since the previous batch and the path as "<include index>/<relative
+    # path>", so a trace can be replayed on any tree. Events of one batch
+    # share a delta of 0 after the first.
+    def __init__(self, path, includes):
+        self.roots = [os.path.normpath(i) for i in includes]
+        self.file = gzip.open(path, 'ab')
+        self.last = None
+        self.events = 0
+
+    def _relative(self, path):
+        for index, root in enumerate(self.roots):
+            if path == root:
+                return f"{index}/"
+            if path.startswith(root + '/'):
+                return f"{index}/{path[len(root) + 1:]}"
+        return None
+
+    def record(self, events):
+        now = time.time()
+        delta_us = 0 if self.last is None else int((now - self.last) * 1e6)
+        self.last = now
+        lines = []
+        for mask, cookie, path in events:
+            relative = self._relative(path)
+            if relative is None:
+                continue
+            lines.append(f"{delta_us} ".encode() + EventJournal._encode(mask, cookie, relative))
+            delta_us = 0
+        self.file.write(b''.join(lines))
+        self.events += len(lines)
+
+    def close(self):
+        self.file.close()
+        logger.info(f"Recorded {self.events} events to {trace_file}")
+
+def open_trace(includes):
+    global trace_recorder
+    if trace_file:
+        try:
+            trace_recorder = TraceRecorder(trace_file, includes)
+        except OSError as e:
+            logger.error(f"Cannot open trace file {trace_file}: {e}")
+    return trace_recorder
+
+def close_trace():
+    if trace_recorder is not None:
+        trace_recorder.close()
+
+# Bucket bounds of the histograms, in seconds or paths
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+BATCH_BUCKETS = (1, 10, 100, 1000, 5000, 10000, 15000, 50000, 100000)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 120, 300, 600, 1800, 3600)
+
+class MetricsRegistry:
+    # Counters, gauges and fixed-bucket histograms in the OpenMetrics text
+    # format. An update takes one lock and touches one dict entry, plus a
+    # bisect for histograms, so it is cheap enough for the event path and
+    # safe from worker threads. Collectors are called at scrape time for
+    # values derived from state kept elsewhere.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+        self.series = {}
+        self.collectors = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _key(labels):
+        # Label values are strings on the wire; a status can be a return
+        # code or "error", and mixed types would not sort on render
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def declare(self, name, kind, help, buckets=None):
+        self.families[name] = (kind, help, buckets)
+        self.series[name] = {}
+
+    def collector(self, name, kind, help, collect):
+        self.families[name] = (kind, help, None)
+        self.collectors[name] = collect
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[name][key] = value
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.series[name].get(self._key(labels))
+
+    def observe(self, name, value, **labels):
+        # One count per bucket plus +Inf, then the sum; cumulated on render
+        buckets = self.families[name][2]
+        key = self._key(labels)
+        with self.lock:
+            series = self.series[name]
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(buckets) + 2)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def observe_counts(self, name, counts, total, **labels):
+        # Adds observations already sorted into the buckets, one count per
+        # bucket plus +Inf, and their sum
+        key = self._key(labels)
+        with self.lock:
+            series = self.series[name]
+            current = series.get(key)
+            if current is None:
+                current = series[key] = [0] * (len(counts) + 1)
+            for i, count in enumerate(counts):
+                current[i] += count
+            current[-1] += total
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        with self.lock:
+            snapshot = {name: {key: list(value) if isinstance(value, list) else value for key, value in series.items()}
+                        for name, series in self.series.items()}
+        for name, collect in self.collectors.items():
+            try:
+                snapshot[name] = {self._key(labels): value for labels, value in collect()}
+            except Exception as e:
+                logger.debug(f"Metrics collector {name} failed: {e}")
+                snapshot[name] = {}
+        lines = []
+        for name, (kind, help, buckets) in self.families.items():
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"# HELP {name} {help}")
+            for key, value in sorted(snapshot[name].items()):
+                if kind == 'counter':
+                    lines.append(f"{name}_total{self._labels(key)} {value}")
+                elif kind == 'gauge':
+                    lines.append(f"{name}{self._labels(key)} {value}")
+                else:
+                    total = 0
+                    for bound, count in zip(buckets + ('+Inf',), value):
+                        total += count
+                        lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {total}")
+                    lines.append(f"{name}_count{self._labels(key)} {total}")
+                    lines.append(f"{name}_sum{self._labels(key)} {value[-1]}")
+        lines.append("# EOF\n")
+        return "\n".join(lines)
+
+def sync_stats_samples():
+    return [({'tool': tool, 'status': status}, value) for (tool, status), value in list(sync_stats.items())]
+
+def node_sync_age_samples():
+    # Nodes that never completed a sync count from the start of the process
+    now = time.time()
+    samples = []
+    for node in nodes:
+        last = metrics.get('csync_node_last_success_timestamp_seconds', node=node)
+        samples.append(({'node': node}, now - (last or metrics.started)))
+    return samples
+
+def node_lag_samples():
+    if replication is None:
+        return []
+    return [({'node': node}, lag) for node, lag in replication.lags().items()]
+
+def dead_letter_samples():
+    if retries is None:
+        return []
+    return [({}, retries.dead_letters)]
+
+metrics = MetricsRegistry()
+metrics.declare('csync_events', 'counter', 'Filesystem events ingested into the pending set')
+metrics.declare('csync_pending_paths', 'gauge', 'Coalesced paths waiting for the next batch')
+metrics.declare('csync_batch_paths', 'histogram', 'Paths per processed batch', BATCH_BUCKETS)
+metrics.declare('csync_flushes', 'counter', 'Batches taken from the pending set by flush reason')
+metrics.declare('csync_check_seconds', 'histogram', 'Duration of csync2 -cr runs', DURATION_BUCKETS)
+metrics.declare('csync_checks', 'counter', 'csync2 -cr runs by exit status')
+metrics.declare('csync_push_seconds', 'histogram', 'Duration of csync2 -ub and rsync runs per node', DURATION_BUCKETS)
+metrics.declare('csync_pushes', 'counter', 'csync2 -ub and rsync runs per node by exit status')
+metrics.declare('csync_rsync_sent_bytes', 'counter', 'Bytes sent by rsync per node')
+metrics.declare('csync_node_last_success_timestamp_seconds', 'gauge', 'Unix time of the last successful push per node')
+metrics.declare('csync_full_sync_tick_seconds', 'histogram', 'Duration of rolling full sync ticks', DURATION_BUCKETS)
+metrics.declare('csync_full_sync_cycle_seconds', 'gauge', 'Duration of the last complete full sync cycle')
+metrics.declare('csync_last_full_sync_timestamp_seconds', 'gauge', 'Unix time the last full sync cycle completed')
+metrics.declare('csync_replication_latency_seconds', 'histogram', 'Time from the first event of a path until a node has it, per include root', LATENCY_BUCKETS)
+metrics.declare('csync_replication_complete_seconds', 'histogram', 'Time from the first event of a path until every node has it, per include root', LATENCY_BUCKETS)
+metrics.collector('csync_node_sync_age_seconds', 'gauge', 'Seconds since the last successful push per node', node_sync_age_samples)
+metrics.collector('csync_node_lag_batches', 'gauge', 'Checked batches not yet pushed per node', node_lag_samples)
+metrics.collector('csync_dead_letters', 'counter', 'Paths written to the dead-letter file after retry_max_attempts failures', dead_letter_samples)
+metrics.collector('csync_sync_stats', 'counter', 'Per-file results of csync2 and rsync runs and inotify queue incidents', sync_stats_samples)
+
+def record_push_metrics(tool, node, elapsed, status):
+    metrics.observe('csync_push_seconds', elapsed, tool=tool, node=node)
+    metrics.inc('csync_pushes', tool=tool, node=node, status=status)
+    if status == 0:
+        metrics.set('csync_node_last_success_timestamp_seconds', time.time(), node=node)
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics endpoint: {format % args}")
+
+class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def open_metrics():
+    # Serves the registry from a daemon thread in both modes, so scrapes
+    # never wait on the event loop or the queue thread
+    global metrics_server
+    if not metrics_listen:
+        return None
+    try:
+        if metrics_listen.startswith("unix:"):
+            path = metrics_listen[len("unix:"):]
+            if os.path.exists(path):
+                os.unlink(path)
+            metrics_server = UnixMetricsServer(path, MetricsHandler)
+        else:
+            host, _, port = metrics_listen.rpartition(':')
+            metrics_server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), MetricsHandler)
+    except (OSError, ValueError) as e:
+        logger.error(f"Cannot serve metrics on {metrics_listen}: {e}")
+        return None
+    threading.Thread(target=metrics_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving OpenMetrics on {metrics_listen}")
+    return metrics_server
+
+def close_metrics():
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+        if isinstance(metrics_server, UnixMetricsServer):
+            with contextlib.suppress(OSError):
+                os.unlink(metrics_server.server_address)
 
 def reset_queue():
     global queue_line_pos
     logger.info("* RESET QUEUE LOG")
     try:
-        open(queue_file, 'w').close()
+        if event_journal is not None:
+            event_journal.compact()
+        else:
+            open(queue_file, 'w').close()
+        if server_monitor is not None:
+            server_monitor.truncate_log()
         queue_line_pos = 1
     except IOError as e:
         logger.error(f"Error resetting queue file: {e}")
 
-async def csync_full_sync(csync_opts, includes, nodes):
+def replay_journal(pending_changes):
     global last_full_sync
-    logger.info("* FULL SYNC")
-
-    csync_server_wait()
-    if shutdown_flag:
+    if event_journal is None:
         return
+    events = event_journal.replay()
+    if events:
+        logger.info(f"Replaying {len(events)} unacknowledged journal events")
+        route_events(events, pending_changes)
+    if event_journal.has_checkpoint:
+        # The journal covers everything seen before the restart, so the
+        # initial full sync can wait for the regular interval
+        last_full_sync = time.time()
+
+def list_directory(path):
+    # (path, [(name, inode, mtime_ns, size, mode)]) without excluded entries,
+    # or (path, None) if the directory cannot be read
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if exclude_matcher(entry.path):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.name, st.st_ino, st.st_mtime_ns, st.st_size, st.st_mode))
+    except OSError as e:
+        logger.warning(f"Cannot list {path}: {e}")
+        return path, None
+    return path, entries
+
+def scan_tree(roots, workers):
+    # Parallel walk: subdirectories are listed by the pool while the caller
+    # consumes the listings that already completed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        pending = {pool.submit(list_directory, root) for root in roots}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, entries = future.result()
+                for name, _, _, _, mode in entries or ():
+                    if stat.S_ISDIR(mode):
+                        pending.add(pool.submit(list_directory, os.path.join(path, name)))
+                yield path, entries
+
+class SnapshotIndex:
+    # SQLite index of the tree as of its last successful check: one row per
+    # path with the lstat fields that reveal a change. Rows are keyed by
+    # (parent, name), so the entries of a directory and a whole subtree are
+    # contiguous key ranges. Every checked chunk refreshes the rows of the
+    # changed paths it covers, walking a subtree only for a directory that
+    # appeared under a new name or a chunk without batch entries (a full
+    # sync shard). Writes are queued to a worker thread so they stay off
+    # the check and push path. Once a full sync cycle has passed the index
+    # is complete, and later starts diff the live tree against it instead
+    # of checking every include.
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            parent TEXT, name TEXT, inode INTEGER, mtime_ns INTEGER, size INTEGER, mode INTEGER,
+            PRIMARY KEY (parent, name)) WITHOUT ROWID""")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()
+        # Kept in memory, the event loop reads it without waiting for the worker
+        self.complete = row is not None and row[0] == '1'
+        self.drained = {}
+        self.assigned = {}  # checked path -> [(changed path, walk)], worker only
+        self.work = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="snapshot", daemon=True)
+        self._thread.start()
+
+    def mark_complete(self):
+        # Queued behind the refreshes of the last shards
+        self.work.put((self._mark_complete, ()))
+
+    def _mark_complete(self):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', '1')")
+        self.complete = True
+
+    def collect(self, ops):
+        self.drained = ops
+
+    def assign(self, paths):
+        self.work.put((self._assign, (self.drained, paths)))
+        self.drained = {}
+
+    def refresh(self, paths):
+        self.work.put((self._refresh, (paths,)))
+
+    def _run(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            method, args = item
+            try:
+                method(*args)
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Cannot update snapshot index: {e}")
+
+    def _assign(self, drained, paths):
+        # Group the changed paths by the checked path covering them. Only a
+        # directory that appeared under a new name needs its subtree
+        # listed, other changes touch a single row.
+        checked = set(paths)
+        covering = {}  # directory -> checked path covering it, or None
+        assigned = {}
+        for path, entry in drained.items():
+            changed = [(path, entry[1] and (entry[2] or entry[0] == OP_RENAME))]
+            if entry[0] == OP_RENAME:
+                changed.append((entry[3], False))
+            for path, walk in changed:
+                if path in checked:
+                    owner = path
+                else:
+                    directory = os.path.dirname(path)
+                    owner = covering.get(directory, False)
+                    if owner is False:
+                        owner = directory
+                        while owner not in checked and owner != os.path.dirname(owner):
+                            owner = os.path.dirname(owner)
+                        owner = covering[directory] = owner if owner in checked else None
+                    if owner is None:
+                        continue
+                assigned.setdefault(owner, []).append((path, walk))
+        self.assigned = assigned
+
+    def _delete_subtree(self, path):
+        # '0' sorts right after '/', so [path/, path0) holds every descendant
+        self.db.execute("DELETE FROM files WHERE parent = ? OR (parent >= ? AND parent < ?)",
+                        (path, path + '/', path + '0'))
+
+    def _put(self, parent, rows):
+        self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                            [(parent,) + row for row in rows])
+
+    def _refresh(self, paths):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for path in paths:
+                    for changed, walk in self.assigned.pop(path, None) or [(path, True)]:
+                        self._refresh_path(changed, walk)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _refresh_path(self, path, walk):
+        parent, name = os.path.split(path)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            self.db.execute("DELETE FROM files WHERE parent = ? AND name = ?", (parent, name))
+            self._delete_subtree(path)
+            return
+        except OSError:
+            return
+        self._put(parent, [(name, st.st_ino, st.st_mtime_ns, st.st_size, st.st_mode)])
+        if walk and stat.S_ISDIR(st.st_mode):
+            self._delete_subtree(path)
+            for directory, entries in scan_tree([path], 1):
+                self._put(directory, entries or [])
+
+    def diff(self, roots):
+        # Walk the live tree and return the events that turn the indexed
+        # state into it; the index is updated on the way
+        start = time.time()
+        events = []
+        scanned = 0
+        roots = [os.path.normpath(r) for r in roots]
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for directory, entries in scan_tree(roots, scan_workers):
+                    if entries is None:
+                        continue
+                    scanned += len(entries)
+                    known = {row[0]: row[1:] for row in self.db.execute(
+                        "SELECT name, inode, mtime_ns, size, mode FROM files WHERE parent = ?", (directory,))}
+                    changed = []
+                    for entry in entries:
+                        name, current = entry[0], entry[1:]
+                        old = known.pop(name, None)
+                        if old == current:
+                            continue
+                        changed.append(entry)
+                        mode = current[3]
+                        replaced = old is None or old[0] != current[0] or stat.S_IFMT(old[3]) != stat.S_IFMT(mode)
+                        if stat.S_ISDIR(mode):
+                            # A changed mtime only means entries changed,
+                            # and those are diffed on their own
+                            if replaced:
+                                events.append((IN_CREATE | IN_ISDIR, 0, os.path.join(directory, name)))
+                        else:
+                            events.append((IN_CREATE if replaced else IN_MODIFY, 0, os.path.join(directory, name)))
+                    self._put(directory, changed)
+                    for name, old in known.items():
+                        path = os.path.join(directory, name)
+                        events.append((IN_DELETE | (IN_ISDIR if stat.S_ISDIR(old[3]) else 0), 0, path))
+                        self.db.execute("DELETE FROM files WHERE parent = ? AND name = ?", (directory, name))
+                        self._delete_subtree(path)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        logger.info(f"Snapshot diff: {len(events)} changes in {scanned} paths, {time.time() - start:.2f}s")
+        return events
+
+    def close(self):
+        self.work.put(None)
+        self._thread.join()
+        with self.lock:
+            self.db.close()
+
+def open_snapshot():
+    global snapshot
+    if use_snapshot:
+        try:
+            snapshot = SnapshotIndex(snapshot_file)
+        except sqlite3.Error as e:
+            logger.error(f"Cannot open snapshot index {snapshot_file}: {e}")
+    return snapshot
+
+def close_snapshot():
+    if snapshot is not None:
+        snapshot.close()
+
+class RescanQueue:
+    # Subtrees whose events may have been lost: every include root after an
+    # inotify queue overflow, a single directory after the kernel dropped
+    # its watch. They are rescanned after every batch and ahead of full
+    # sync shards, for at most full_sync_budget seconds per turn, and the
+    # changed paths found go
+    # through the normal batching. Recovery time is measured from the first
+    # loss until the queue is empty again.
+    def __init__(self, includes):
+        self.roots = [os.path.normpath(i) for i in includes]
+        self.dirty = {}  # path -> time marked
+        self.overflows = 0
+        self.lost_watches = 0
+        self.since = None
+
+    def __bool__(self):
+        return bool(self.dirty)
+
+    def mark(self, mask, path):
+        if mask & IN_Q_OVERFLOW:
+            self.overflows += 1
+            sync_stats[('inotify', 'overflow')] += 1
+            paths = self.roots
+        elif os.path.isdir(path):
+            self.lost_watches += 1
+            sync_stats[('inotify', 'lost_watch')] += 1
+            logger.warning(f"Watch on {path} was dropped, rescanning it")
+            paths = [path]
+        else:
+            return
+        now = time.time()
+        if self.since is None:
+            self.since = now
+        for path in paths:
+            if any(path == d or path.startswith(d + '/') for d in self.dirty):
+                continue
+            for d in [d for d in self.dirty if d.startswith(path + '/')]:
+                del self.dirty[d]
+            self.dirty[path] = now
+
+    def take(self):
+        path = next(iter(self.dirty))
+        del self.dirty[path]
+        return path
+
+    def finished(self):
+        if self.dirty or self.since is None:
+            return
+        logger.info(f"Recovered from {self.overflows} overflow(s) and {self.lost_watches} lost watch(es) in {time.time() - self.since:.1f}s")
+        sync_stats[('inotify', 'recovery_seconds')] += time.time() - self.since
+        self.overflows = self.lost_watches = 0
+        self.since = None
+
+def rescan_events(path, events):
+    if events is None:
+        # Without a complete snapshot csync2 -cr rescans the subtree
+        events = [(IN_CREATE | IN_ISDIR, 0, path)]
+    logger.info(f"* RESCAN {path}: {len(events)} change(s)")
+    return events
+
+async def rescan_subtrees_async(pending_changes, scheduler):
+    start = time.time()
+    while rescans and time.time() - start < full_sync_budget and not shutdown_flag:
+        path = rescans.take()
+        events = await asyncio.to_thread(snapshot.diff, [path]) if snapshot is not None and snapshot.complete else None
+        ingest_events(rescan_events(path, events), pending_changes, scheduler)
+    rescans.finished()
+
+def rescan_subtrees(pending_changes, scheduler):
+    start = time.time()
+    while rescans and time.time() - start < full_sync_budget and not shutdown_flag:
+        path = rescans.take()
+        events = snapshot.diff([path]) if snapshot is not None and snapshot.complete else None
+        ingest_events(rescan_events(path, events), pending_changes, scheduler)
+    rescans.finished()
+
+class FlushScheduler:
+    # Deadline-based flush policy. An exponentially weighted moving average
+    # of the event rate (time constant rate_window) sets the quiet period
+    # that must pass without events before a flush: a lone change flushes
+    # after min_quiet_time, a sustained burst holds back up to
+    # max_quiet_time. max_wait_time caps the latency of the oldest pending
+    # event and max_pending caps the batch size.
+    def __init__(self):
+        self.rate = 0.0
+        self.last_event = None
+        self.first_pending = None
+
+    def observe(self, count, now=None):
+        now = now or time.time()
+        # Decaying the average by elapsed time rather than per batch keeps
+        # batches that arrive microseconds apart from looking like a storm
+        if self.last_event is not None:
+            self.rate *= math.exp(-max(now - self.last_event, 0) / rate_window)
+        self.rate += count / rate_window
+        self.last_event = now
+        if self.first_pending is None:
+            self.first_pending = now
+
+    def quiet_period(self):
+        quiet = min_quiet_time * (1 + self.rate / quiet_rate_scale)
+        return min(max(quiet, min_quiet_time), max_quiet_time)
+
+    def deadline(self):
+        if self.first_pending is None:
+            return None
+        return min(self.last_event + self.quiet_period(), self.first_pending + max_wait_time)
+
+    def timeout(self, now=None):
+        # Never negative: an already passed deadline still lets the queue
+        # be polled once before the flush
+        deadline = self.deadline()
+        if deadline is None:
+            return check_interval
+        now = now or time.time()
+        return min(check_interval, max(deadline - now, 0.001))
+
+    def due(self, pending, now=None):
+        if self.first_pending is None:
+            return None
+        if not pending:
+            self.first_pending = None
+            return None
+        now = now or time.time()
+        if pending >= max_pending:
+            return "size"
+        if now - self.first_pending >= max_wait_time:
+            return "latency"
+        if now - self.last_event >= self.quiet_period():
+            return "quiet"
+        return None
+
+    def flushed(self):
+        self.first_pending = None
+
+def route_events(events, pending_changes):
+    if any(mask & RESCAN_MASK for mask, _, _ in events):
+        for mask, _, path in events:
+            if mask & RESCAN_MASK:
+                rescans.mark(mask, path)
+        events = [event for event in events if not event[0] & RESCAN_MASK]
+    pending_changes.add_batch(events)
+
+def ingest_watcher_events(events, pending_changes, scheduler):
+    # Events straight from the watcher, the only ones a trace records
+    if trace_recorder is not None:
+        trace_recorder.record(events)
+    ingest_events(events, pending_changes, scheduler)
+
+def ingest_events(events, pending_changes, scheduler):
+    if event_journal is not None:
+        event_journal.append(events)
+    route_events(events, pending_changes)
+    scheduler.observe(len(events))
+    metrics.inc('csync_events', len(events))
+    metrics.set('csync_pending_paths', len(pending_changes))
+
+def take_batch(pending_changes, scheduler, includes, reason):
+    global queue_line_pos
+    logger.info(f"* PROCESSING QUEUE (line {queue_line_pos}, {reason})")
+    journal_offset = event_journal.commit() if event_journal is not None else 0
+    ops = pending_changes.drain()
+    latency_tracker.collect(ops)
+    if snapshot is not None:
+        snapshot.collect(ops)
+    csync_files = collapse_paths(coalesced_paths(ops), includes)
+    scheduler.flushed()
+    queue_line_pos += len(csync_files)
+    metrics.set('csync_pending_paths', len(pending_changes))
+    metrics.observe('csync_batch_paths', len(csync_files))
+    metrics.inc('csync_flushes', reason=reason)
+    return csync_files, journal_offset
+
+def argv_budget():
+    # Bytes available for argv: ARG_MAX minus the environment (strings plus
+    # pointers) and a safety margin, optionally capped by --max-argv-bytes
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        arg_max = 128 * 1024
+    env_bytes = sum(len(os.fsencode(k)) + len(os.fsencode(v)) + 2 + 8 for k, v in os.environ.items())
+    budget = arg_max - env_bytes - 4096
+    if max_argv_bytes:
+        budget = min(budget, max_argv_bytes)
+    return max(budget, 4096)
+
+def chunk_paths(base_cmd, paths, budget=None):
+    # Split paths so that base_cmd + chunk never exceeds the argv budget;
+    # every argument costs its bytes, a NUL terminator and a pointer
+    if budget is None:
+        budget = argv_budget()
+    base = sum(len(os.fsencode(arg)) + 1 + 8 for arg in base_cmd)
+    chunks = []
+    chunk, size = [], base
+    for path in paths:
+        cost = len(os.fsencode(path)) + 1 + 8
+        if chunk and size + cost > budget:
+            chunks.append(chunk)
+            chunk, size = [], base
+        chunk.append(path)
+        size += cost
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def log_chunk_report(paths, timings, failed):
+    details = ", ".join(f"{t:.2f}s" for t in timings)
+    logger.info(f"  Checked {len(paths)} paths in {len(timings)} chunk(s) [{details}]"
+                + (f", {failed} failed" if failed else ""))
+
+# Per-file lines of csync2 (-v) and rsync (-i) output, first match wins
+SYNC_OUTPUT_PATTERNS = {
+    'csync2': [
+        ('conflict', re.compile(r'^File is also marked dirty here: (.+)$')),
+        ('failed', re.compile(r'^While syncing file (.+):$')),
+        ('updated', re.compile(r'^Updating (.+) on \S+ \.\.\.')),
+        ('deleted', re.compile(r'^Deleting (.+) on \S+ \.\.\.')),
+        ('dirty', re.compile(r'^Marking file as dirty: (.+)$')),
+    ],
+    'rsync': [
+        ('deleted', re.compile(r'^\*deleting\s+(.+)$')),
+        ('updated', re.compile(r'^[<>ch.][fdLDS]\S{9} (.+)$')),
+        ('failed', re.compile(r'^rsync: .*?"(.+?)"')),
+    ],
+}
+
+# Transfer summary printed by rsync --info=stats1
+RSYNC_SENT_PATTERN = re.compile(r'^sent ([\d,.]+) bytes\s')
+
+class SyncOutput:
+    # Parses the output of one csync2 or rsync run line by line while it is
+    # produced. Only per-status counts, a bounded list of (status, path)
+    # records that need attention and the last error lines are kept, so a
+    # verbose run over a large batch never accumulates in memory.
+    def __init__(self, tool, label):
+        self.tool = tool
+        self.label = label
+        self.patterns = SYNC_OUTPUT_PATTERNS[tool]
+        self.counts = collections.Counter()
+        self.records = []
+        self.dropped = 0
+        self.errors = collections.deque(maxlen=10)
+        self.lines = 0
+        self.sent_bytes = 0
+
+    def feed(self, line):
+        line = line.decode(errors='replace').rstrip('\n') if isinstance(line, bytes) else line.rstrip('\n')
+        if not line:
+            return
+        self.lines += 1
+        for status, pattern in self.patterns:
+            match = pattern.match(line)
+            if match:
+                self.counts[status] += 1
+                if status in ('failed', 'conflict'):
+                    if len(self.records) < max_output_records:
+                        self.records.append((status, match.group(1)))
+                    else:
+                        self.dropped += 1
+                return
+        if self.tool == 'rsync':
+            match = RSYNC_SENT_PATTERN.match(line)
+            if match:
+                self.sent_bytes += int(re.sub(r'\D', '', match.group(1)))
+                return
+        if 'error' in line.lower():
+            self.errors.append(line)
+        else:
+            logger.debug(f"{self.tool} {self.label}: {line}")
+
+    def paths(self, status):
+        return [path for s, path in self.records if s == status]
+
+    def log(self, returncode):
+        for status, count in self.counts.items():
+            sync_stats[(self.tool, status)] += count
+        if self.counts:
+            summary = ", ".join(f"{status}={count}" for status, count in sorted(self.counts.items()))
+            logger.debug(f"{self.tool} {self.label}: {summary}")
+        for path in self.paths('conflict'):
+            logger.warning(f"Conflict on {path} ({self.label}), run 'csync2 -f {path}' on the authoritative node to resolve it")
+        failed = self.paths('failed')
+        if failed:
+            more = f" (+{self.dropped} more)" if self.dropped else ""
+            logger.error(f"{self.tool} {self.label} failed for {len(failed)} file(s){more}: {' '.join(failed[:20])}")
+        if returncode != 0 or self.errors:
+            for line in self.errors:
+                logger.error(f"{self.tool} {self.label}: {line}")
+        if returncode != 0:
+            logger.error(f"{self.tool} {self.label} exited with status {returncode}")
+
+async def run_sync_command(cmd, output, stdin_data=None):
+    # stderr is merged into stdout, csync2 reports everything on stderr.
+    # stdin_data is written while the output is read, so neither pipe can
+    # fill up and stall the command.
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if stdin_data is not None else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=1024 * 1024
+    )
 
+    async def write_stdin():
+        with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+            process.stdin.write(stdin_data)
+            await process.stdin.drain()
+        process.stdin.close()
+
+    writer = asyncio.create_task(write_stdin()) if stdin_data is not None else None
+    try:
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            output.feed(line)
+        if writer is not None:
+            await writer
+    except BaseException:
+        if writer is not None:
+            writer.cancel()
+        with contextlib.suppress(ProcessLookupError):
+            process.kill()
+        raise
+    return await process.wait()
+
+def write_stdin_threaded(pipe, data):
+    with contextlib.suppress(BrokenPipeError):
+        with pipe:
+            pipe.write(data)
+
+def run_sync_command_threaded(cmd, output, stdin_data=None):
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE if stdin_data is not None else None,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+        writer = None
+        if stdin_data is not None:
+            writer = threading.Thread(target=write_stdin_threaded, args=(process.stdin, stdin_data), daemon=True)
+            writer.start()
+        for line in process.stdout:
+            output.feed(line)
+        if writer is not None:
+            writer.join()
+    return process.returncode
+
+class RetryTracker:
+    # Paths whose csync2 check (node None) or push to a node failed, with
+    # their attempt count per node. A failed path is re-queued as a change
+    # after an exponential backoff with jitter; after retry_max_attempts
+    # failures it is written to the dead-letter file instead. A re-queued
+    # path is checked and pushed to every node again, so it is due once the
+    # first node's backoff ran out, and its journal hold is released only
+    # when no node is left waiting for it. Shared by the queue loop and the
+    # node pipelines, hence the lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = {}  # (node, path) -> failed attempts
+        self.waiting = {}  # path -> {node: time it is due for a retry}
+        self.dead_letters = 0
+
+    def _backoff(self, attempts):
+        delay = min(retry_max_delay, retry_base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def fail(self, node, paths):
+        now = time.time()
+        dead = []
+        released = []
+        waiting = []
+        with self.lock:
+            for path in paths:
+                key = (node, path)
+                attempts = self.attempts.get(key, 0) + 1
+                if attempts > retry_max_attempts:
+                    del self.attempts[key]
+                    dead.append(path)
+                    nodes = self.waiting.get(path)
+                    if nodes is not None:
+                        nodes.pop(node, None)
+                        if nodes:
+                            continue
+                        del self.waiting[path]
+                    released.append(path)
+                    continue
+                self.attempts[key] = attempts
+                due = now + self._backoff(attempts)
+                nodes = self.waiting.setdefault(path, {})
+                nodes[node] = min(nodes.get(node, due), due)
+                waiting.append(path)
+        if event_journal is not None:
+            event_journal.hold(waiting)
+            event_journal.release(released)
+        if len(paths) > len(dead):
+            logger.warning(f"  {len(paths) - len(dead)} path(s) failed on {node or 'check'}, retrying with backoff")
+        if dead:
+            self._dead_letter(node, dead)
+
+    def _dead_letter(self, node, paths):
+        self.dead_letters += len(paths)
+        logger.error(f"Giving up on {len(paths)} path(s) for {node or 'check'} after {retry_max_attempts} attempts, see {dead_letter_file}")
+        try:
+            with open(dead_letter_file, 'a') as f:
+                stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+                for path in paths:
+                    f.write(f"{stamp} {node or '-'} {path}\n")
+        except OSError as e:
+            logger.error(f"Cannot write dead-letter file {dead_letter_file}: {e}")
+
+    def succeed(self, node, paths=None):
+        with self.lock:
+            if paths is None:
+                for key in [k for k in self.attempts if k[0] == node]:
+                    del self.attempts[key]
+            else:
+                for path in paths:
+                    self.attempts.pop((node, path), None)
+
+    def record_push(self, node, output, returncode):
+        # A push that failed without naming files is retried as a whole by
+        # the node pipeline; per-file failures are retried here
+        failed = output.paths('failed')
+        if failed:
+            self.fail(node, failed)
+        if returncode == 0:
+            with self.lock:
+                failed = set(failed)
+                for key in [k for k in self.attempts if k[0] == node and k[1] not in failed]:
+                    del self.attempts[key]
+
+    def take_due(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            due = [path for path, nodes in self.waiting.items() if min(nodes.values()) <= now]
+            for path in due:
+                del self.waiting[path]
+        # Re-queued paths are journaled again as they are ingested
+        if due and event_journal is not None:
+            event_journal.release(due)
+        return due
+
+def requeue_retries(pending_changes, scheduler):
+    paths = retries.take_due()
+    if paths:
+        logger.info(f"Retrying {len(paths)} failed path(s)")
+        ingest_events([(IN_MODIFY, 0, path) for path in paths], pending_changes, scheduler)
+
+class ConcurrencyLimiter:
+    # Global and per-node slots for csync2 and rsync subprocesses. A caller
+    # takes its node's slot before a global one, so waiting on a busy node
+    # never holds a global slot. Time spent waiting is recorded per node
+    # (None for local work) and summarized by report().
+    def __init__(self, nodes, total, per_node, threaded=False):
+        self.threaded = threaded
+        semaphore = threading.BoundedSemaphore if threaded else asyncio.Semaphore
+        self.total = semaphore(total) if total > 0 else None
+        self.node_slots = {node: semaphore(per_node) for node in nodes} if per_node > 0 else {}
+        self.lock = threading.Lock()
+        self.waits = {}  # node -> [count, total wait, max wait]
+
+    def _record(self, node, waited):
+        with self.lock:
+            entry = self.waits.setdefault(node, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += waited
+            entry[2] = max(entry[2], waited)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, node=None):
+        start = time.time()
+        node_slot = self.node_slots.get(node)
+        if node_slot is not None:
+            await node_slot.acquire()
+        try:
+            if self.total is not None:
+                await self.total.acquire()
+            try:
+                self._record(node, time.time() - start)
+                yield
+            finally:
+                if self.total is not None:
+                    self.total.release()
+        finally:
+            if node_slot is not None:
+                node_slot.release()
+
+    @contextlib.contextmanager
+    def slot_threaded(self, node=None):
+        start = time.time()
+        node_slot = self.node_slots.get(node)
+        if node_slot is not None:
+            node_slot.acquire()
+        try:
+            if self.total is not None:
+                self.total.acquire()
+            try:
+                self._record(node, time.time() - start)
+                yield
+            finally:
+                if self.total is not None:
+                    self.total.release()
+        finally:
+            if node_slot is not None:
+                node_slot.release()
+
+    def report(self):
+        with self.lock:
+            waits, self.waits = self.waits, {}
+        for node, (count, total, longest) in waits.items():
+            if longest >= 0.01:
+                logger.info(f"  Slot wait {node or 'local'}: {count} jobs, avg {total / count * 1000:.0f}ms, max {longest * 1000:.0f}ms")
+        return waits
+
+class NodePipeline:
+    # Push worker for one node. Every successful check publishes a new
+    # generation; the worker runs csync2 -ub -P node until its acked cursor
+    # reaches the latest generation. -ub pushes everything dirty for the
+    # node, so generations published during a push collapse into the next
+    # one and a slow node never holds back the others.
+    def __init__(self, node, csync_opts, condition):
+        self.node = node
+        self.csync_opts = csync_opts
+        self.condition = condition
+        self.target = 0
+        self.acked = 0
+        self.failing = False
+        self.wakeup = None
+        self.task = None
+
+    @property
+    def lag(self):
+        return self.target - self.acked
+
+    def submit(self, generation):
+        self.target = max(self.target, generation)
+        self.wakeup.set()
+
+    def _acknowledge(self, generation, ok):
+        self.failing = not ok
+        if ok:
+            self.acked = generation
+            latency_tracker.pushed(self.node, generation)
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while not shutdown_flag:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.acked < self.target and not shutdown_flag:
+                generation = self.target
+                ok = await update_node_async(self.node, self.csync_opts)
+                self._acknowledge(generation, ok)
+                async with self.condition:
+                    self.condition.notify_all()
+                if not ok:
+                    await asyncio.sleep(node_retry_delay)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+class ThreadedNodePipeline(NodePipeline):
+    def start(self):
+        self.wakeup = threading.Event()
+        self.task = threading.Thread(target=self.run, name=f"push-{self.node}", daemon=True)
+        self.task.start()
+
+    def run(self):
+        while not shutdown_flag:
+            if not self.wakeup.wait(1):
+                continue
+            self.wakeup.clear()
+            while self.acked < self.target and not shutdown_flag:
+                generation = self.target
+                ok = update_node_threaded(self.node, self.csync_opts)
+                with self.condition:
+                    self._acknowledge(generation, ok)
+                    self.condition.notify_all()
+                if not ok:
+                    time.sleep(node_retry_delay)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.join(timeout=5)
+
+class ReplicationPipelines:
+    # One NodePipeline per node plus the shared generation counter. Checks
+    # wait for capacity while a healthy node lags more than max_node_lag
+    # generations behind; nodes whose last push failed do not hold back
+    # the others. The paths of every generation stay in flight until all
+    # healthy nodes pushed it, so a later check touching the same paths
+    # can be ordered after that push while unrelated checks overlap it.
+    def __init__(self, nodes, csync_opts, threaded=False):
+        self.threaded = threaded
+        self.condition = threading.Condition() if threaded else asyncio.Condition()
+        pipeline_class = ThreadedNodePipeline if threaded else NodePipeline
+        self.pipelines = {node: pipeline_class(node, csync_opts, self.condition) for node in nodes}
+        self.generation = 0
+        self.inflight = {}  # generation -> checked paths not yet pushed everywhere
+
+    def start(self):
+        for pipeline in self.pipelines.values():
+            pipeline.start()
+
+    def stop(self):
+        for pipeline in self.pipelines.values():
+            pipeline.stop()
+
+    def publish(self, paths=()):
+        self.generation += 1
+        if paths:
+            self.inflight[self.generation] = paths
+            latency_tracker.publish(self.generation, paths)
+        for pipeline in self.pipelines.values():
+            pipeline.submit(self.generation)
+        return self.generation
+
+    def pushed_generation(self):
+        healthy = [p.acked for p in self.pipelines.values() if not p.failing]
+        return min(healthy) if healthy else self.generation
+
+    def overlapping_generation(self, paths):
+        # Newest in-flight generation sharing a path with paths, counting a
+        # directory as overlapping everything below it
+        pushed = self.pushed_generation()
+        for generation in [g for g in self.inflight if g <= pushed]:
+            del self.inflight[generation]
+        if not self.inflight:
+            return 0
+        exact, ancestors = {}, {}
+        for generation, inflight_paths in self.inflight.items():
+            for path in inflight_paths:
+                exact[path] = generation
+                parent = os.path.dirname(path)
+                while parent not in ('/', '') and ancestors.get(parent, 0) < generation:
+                    ancestors[parent] = generation
+                    parent = os.path.dirname(parent)
+        newest = 0
+        for path in paths:
+            newest = max(newest, exact.get(path, 0), ancestors.get(path, 0))
+            parent = os.path.dirname(path)
+            while parent not in ('/', ''):
+                newest = max(newest, exact.get(parent, 0))
+                parent = os.path.dirname(parent)
+        return newest
+
+    async def wait_for_generation(self, generation):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.pushed_generation() >= generation or shutdown_flag)
+
+    def wait_for_generation_threaded(self, generation):
+        with self.condition:
+            while not (self.pushed_generation() >= generation or shutdown_flag):
+                self.condition.wait(1)
+
+    def lags(self):
+        return {node: pipeline.lag for node, pipeline in self.pipelines.items()}
+
+    def _has_capacity(self):
+        return all(p.lag <= max_node_lag or p.failing for p in self.pipelines.values())
+
+    def _log_backpressure(self):
+        lagging = {n: p.lag for n, p in self.pipelines.items() if p.lag > max_node_lag and not p.failing}
+        logger.info(f"  Waiting for lagging nodes: {lagging}")
+
+    async def wait_for_capacity(self):
+        async with self.condition:
+            if not self._has_capacity():
+                self._log_backpressure()
+                await self.condition.wait_for(lambda: self._has_capacity() or shutdown_flag)
+
+    def wait_for_capacity_threaded(self):
+        with self.condition:
+            if not self._has_capacity():
+                self._log_backpressure()
+                while not (self._has_capacity() or shutdown_flag):
+                    self.condition.wait(1)
+
+class LatencyTracker:
+    # Event to replication latency of every coalesced path. take_batch
+    # hands over the drained entries with their first-seen times, which are
+    # grouped by the checked path covering them once the batch is collapsed
+    # and coarsened. Each published generation or rsync transfer keeps its
+    # times per include root as a sorted array of doubles with their sum.
+    # When a node acknowledges it, the latencies fall into the histogram
+    # buckets with one bisect per bucket, so an acknowledgement costs the
+    # same for ten paths or a hundred thousand. Times of paths whose check
+    # failed are carried over to their retry.
+    def __init__(self, nodes, includes):
+        self.lock = threading.Lock()
+        self.nodes = frozenset(nodes)
+        self.roots = sorted((os.path.normpath(i) for i in includes), key=len, reverse=True)
+        self.drained = {}
+        self.assigned = {}  # checked path -> first-seen times it covers
+        self.carried = {}  # path of a failed check -> first-seen times
+        self.generations = {}  # generation -> {root: [times, sum, waiting nodes]}
+        self.transfers = {}  # rsync transfer -> {root: [times, sum, waiting nodes]}
+        self.transfer_count = 0
+        self.stored = 0
+        self.dropped = 0
+        self.window = {}  # (node or None for all nodes, root) -> bucket counts
+        self.last_report = time.time()
+
+    def _root(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + '/'):
+                return root
+        return '-'
+
+    def collect(self, ops):
+        self.drained = ops
+
+    def assign(self, paths):
+        # Paths not published since the last batch failed their check; the
+        # retry picks their times up again
+        for path, times in self.assigned.items():
+            self.carried.setdefault(path, []).extend(times)
+        if self.carried:
+            horizon = time.time() - max_wait_time - retry_max_attempts * retry_max_delay
+            self.carried = {path: times for path, times in self.carried.items() if min(times) >= horizon}
+        checked = set(paths)
+        covering = {}  # directory -> checked path covering it, or None
+        assigned = {}
+        carried = self.carried
+        for path, entry in self.drained.items():
+            if path in checked:
+                owner = path
+            else:
+                directory = os.path.dirname(path)
+                owner = covering.get(directory, False)
+                if owner is False:
+                    owner = directory
+                    while owner not in checked and owner != os.path.dirname(owner):
+                        owner = os.path.dirname(owner)
+                    owner = covering[directory] = owner if owner in checked else None
+                if owner is None:
+                    continue
+            times = assigned.get(owner)
+            if times is None:
+                times = assigned[owner] = []
+            if carried and path in carried:
+                times.extend(carried.pop(path))
+            else:
+                times.append(entry[4])
+        self.drained = {}
+        self.assigned = assigned
+
+    def _take(self, paths):
+        roots = {}
+        if self.assigned:
+            for path in paths:
+                times = self.assigned.pop(path, None)
+                if times:
+                    roots.setdefault(self._root(path), []).extend(times)
+        return roots
+
+    def _store(self, batches, key, roots):
+        batch = {}
+        for root, times in roots.items():
+            times.sort()
+            batch[root] = [array.array('d', times), math.fsum(times), set(self.nodes)]
+        with self.lock:
+            batches[key] = batch
+            self.stored += sum(len(entry[0]) for entry in batch.values())
+            # A node that stays down keeps every generation waiting, give
+            # up on the oldest ones instead of growing without bound
+            while self.stored > max_latency_paths and (self.generations or self.transfers):
+                oldest = self.generations if self.generations else self.transfers
+                for entry in oldest.pop(next(iter(oldest))).values():
+                    self.stored -= len(entry[0])
+                    self.dropped += len(entry[0])
+
+    def publish(self, generation, paths):
+        roots = self._take(paths)
+        if roots:
+            self._store(self.generations, generation, roots)
+
+    def publish_transfer(self, paths):
+        self.transfer_count += 1
+        roots = self._take(paths)
+        if roots:
+            self._store(self.transfers, self.transfer_count, roots)
+        return self.transfer_count
+
+    def _observe(self, node, root, times, total, now):
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        below = 0
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            within = len(times) - bisect.bisect_left(times, now - bound)
+            counts[i] = within - below
+            below = within
+        counts[-1] = len(times) - below
+        if node is None:
+            metrics.observe_counts('csync_replication_complete_seconds', counts, len(times) * now - total, root=root)
+        else:
+            metrics.observe_counts('csync_replication_latency_seconds', counts, len(times) * now - total, node=node, root=root)
+        window = self.window.setdefault((node, root), [0] * len(counts))
+        for i, count in enumerate(counts):
+            window[i] += count
+
+    def _replicated(self, batches, key, node, root, now):
+        batch = batches.get(key)
+        if batch is None:
+            return
+        for r in [root] if root is not None else list(batch):
+            entry = batch.get(r)
+            if entry is None or node not in entry[2]:
+                continue
+            times, total, waiting = entry
+            self._observe(node, r, times, total, now)
+            waiting.discard(node)
+            if not waiting:
+                self._observe(None, r, times, total, now)
+                del batch[r]
+                self.stored -= len(times)
+        if not batch:
+            del batches[key]
+
+    def pushed(self, node, generation):
+        # -ub pushes everything dirty, so an acknowledged generation covers
+        # all earlier ones
+        now = time.time()
+        with self.lock:
+            for key in [g for g in self.generations if g <= generation]:
+                self._replicated(self.generations, key, node, None, now)
+
+    def transferred(self, key, node, include):
+        now = time.time()
+        with self.lock:
+            self._replicated(self.transfers, key, node, os.path.normpath(include), now)
+
+    def finish_transfer(self, key):
+        # Paths a failed rsync left behind are retried through csync2 and
+        # counted from their retry
+        with self.lock:
+            batch = self.transfers.pop(key, None)
+            if batch:
+                self.stored -= sum(len(entry[0]) for entry in batch.values())
+
+    @staticmethod
+    def _quantile(q, counts):
+        rank = q * sum(counts)
+        cumulative, lower = 0, 0
+        for bound, count in zip(LATENCY_BUCKETS, counts):
+            if count and cumulative + count >= rank:
+                return f"{lower + (bound - lower) * (rank - cumulative) / count:.2f}s"
+            cumulative += count
+            lower = bound
+        return f">{LATENCY_BUCKETS[-1]}s"
+
+    def report(self, now=None):
+        now = now or time.time()
+        if not latency_report_interval or now - self.last_report < latency_report_interval:
+            return
+        with self.lock:
+            window, self.window = self.window, {}
+            dropped, self.dropped = self.dropped, 0
+        elapsed = now - self.last_report
+        self.last_report = now
+        for root in sorted({root for _, root in window}):
+            parts = []
+            for node in [None] + sorted(self.nodes):
+                counts = window.get((node, root))
+                if counts:
+                    parts.append(f"{node or 'all nodes'} p50 {self._quantile(0.5, counts)} p90 {self._quantile(0.9, counts)} "
+                                 f"p99 {self._quantile(0.99, counts)} ({sum(counts)} paths)")
+            logger.info(f"  Replication latency of {root} over {elapsed:.0f}s: " + "; ".join(parts))
+        if dropped:
+            logger.warning(f"  Stopped tracking the latency of {dropped} path(s) still waiting for a node")
+
+class RollingFullSync:
+    # Spreads the periodic full check over full_sync_interval. The include
+    # roots are split into shards, either a subtree checked with -cr or a
+    # group of files of a split directory, and each tick checks shards for
+    # at most full_sync_budget seconds. Ticks are spaced so that the
+    # remaining shards finish by the end of the cycle, or run back to back
+    # while catching up after a start without journal checkpoint. A subtree
+    # that takes longer than the budget is split into its children in the
+    # next cycle. Paths listed in the previous cycle but gone now are
+    # checked once more so csync2 notices their deletion.
+    def __init__(self, includes, catch_up=False):
+        self.roots = [os.path.normpath(i) for i in includes]
+        self.split = set(self.roots)
+        self.shards = collections.deque()
+        self.listed = set()
+        self.catch_up = catch_up
+        self.cycle_start = None
+        self.deadline = 0
+        self.next_tick = 0
+        self.checked = 0
+
+    def _shards_of(self, path, listed):
+        listed.add(path)
+        if path not in self.split:
+            return [[path]]
+        dirs, files = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if exclude_matcher(entry.path):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    else:
+                        files.append(entry.path)
+        except OSError as e:
+            logger.warning(f"Cannot list {path} for full sync, checking it as a whole: {e}")
+            return [[path]]
+        shards = []
+        for d in sorted(dirs):
+            shards += self._shards_of(d, listed)
+        files.sort()
+        listed.update(files)
+        for i in range(0, len(files), shard_files):
+            shards.append(files[i:i + shard_files])
+        return shards
+
+    def start_cycle(self, now):
+        listed = set()
+        shards = []
+        for root in self.roots:
+            shards += self._shards_of(root, listed)
+        vanished = sorted(self.listed - listed)
+        for i in range(0, len(vanished), shard_files):
+            shards.append(vanished[i:i + shard_files])
+        self.listed = listed
+        self.shards = collections.deque(shards)
+        self.cycle_start = now
+        if self.catch_up and shards:
+            self.deadline = self.next_tick = now
+        else:
+            self.deadline = now + full_sync_interval
+            self.next_tick = now + full_sync_interval / max(len(shards), 1)
+        self.checked = 0
+        logger.info(f"* FULL SYNC cycle: {len(shards)} shards" + (", catching up" if self.catch_up else f" over {full_sync_interval}s"))
+        self.catch_up = False
+
+    def due(self, now=None):
+        now = now or time.time()
+        if self.cycle_start is None or (not self.shards and now >= self.deadline):
+            self.start_cycle(now)
+        return bool(self.shards) and now >= self.next_tick
+
+    def take(self):
+        return self.shards.popleft()
+
+    def finished(self, shard, elapsed, now=None):
+        now = now or time.time()
+        self.checked += 1
+        if elapsed > full_sync_budget and len(shard) == 1 and shard[0] not in self.split and os.path.isdir(shard[0]):
+            logger.debug(f"Shard {shard[0]} took {elapsed:.2f}s, splitting it from the next cycle")
+            self.split.add(shard[0])
+        if self.shards:
+            self.next_tick = now + max(self.deadline - now, 0) / len(self.shards)
+            return False
+        logger.info(f"  Full sync cycle complete: {self.checked} shards in {now - self.cycle_start:.1f}s")
+        metrics.set('csync_full_sync_cycle_seconds', now - self.cycle_start)
+        return True
+
+def coarsen_paths(paths, includes):
+    # Reduce a batch too large to list to its ancestors at the deepest
+    # level below the include roots that brings it under the threshold, so
+    # only the subtrees that changed are rechecked. A batch no level can
+    # reduce enough is passed on as it is, argv chunking handles its size.
+    roots = sorted((os.path.normpath(i) for i in includes), key=len, reverse=True)
+    split = []
+    for path in paths:
+        for root in roots:
+            if path == root or path.startswith(root + '/'):
+                rest = path[len(root) + 1:]
+                split.append((root, rest.split('/') if rest else []))
+                break
+    for depth in range(max((len(parts) for _, parts in split), default=0) - 1, 0, -1):
+        result = {root + '/' + '/'.join(parts[:depth]) if parts else root for root, parts in split}
+        if len(result) < num_batched_changes_threshold:
+            return sorted(result)
+    return paths
+
+async def csync_full_sync(csync_opts, nodes, reconciler, preempted):
+    # One tick of the rolling full sync; yields to incremental batches
+    # between shards
+    global last_full_sync
+    await server_monitor.wait_ready()
+
+    start = time.time()
+    shards = paths = 0
+    complete = False
+    while not (shutdown_flag or complete or preempted()) and time.time() - start < full_sync_budget and reconciler.due():
+        shard = reconciler.take()
+        shard_start = time.time()
+        await csync_check_and_push_async(csync_opts, shard, nodes, report=False)
+        complete = reconciler.finished(shard, time.time() - shard_start)
+        shards += 1
+        paths += len(shard)
+
+    if shards:
+        logger.info(f"* FULL SYNC tick: {shards} shard(s), {paths} paths in {time.time() - start:.2f}s, {len(reconciler.shards)} left")
+        metrics.observe('csync_full_sync_tick_seconds', time.time() - start)
+        limiter.report()
+    if complete:
+        last_full_sync = time.time()
+        metrics.set('csync_last_full_sync_timestamp_seconds', last_full_sync)
+        if snapshot is not None:
+            snapshot.mark_complete()
+
+async def csync_check_chunk_async(csync_opts, chunk):
+    output = SyncOutput("csync2", "check")
     try:
-        logger.debug("Running csync2 check")
-        process = await asyncio.create_subprocess_exec(
-            "csync2", *csync_opts, "-cr", *includes,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        logger.debug(f"Csync2 check result: {stdout.decode()}")
-        if stderr:
-            logger.error(f"Csync2 check error: {stderr.decode()}")
+        async with limiter.slot():
+            start = time.time()
+            returncode = await run_sync_command(["csync2", *csync_opts, "-cr", *chunk], output)
     except Exception as e:
         logger.error(f"Error during csync2 check: {e}")
-        return
-
-    update_tasks = [update_node_async(node, csync_opts) for node in nodes]
-    await asyncio.gather(*update_tasks)
-
-    last_full_sync = time.time()
-    logger.info("  Done")
+        metrics.inc('csync_checks', status="error")
+        return False, []
+    metrics.observe('csync_check_seconds', time.time() - start)
+    metrics.inc('csync_checks', status=returncode)
+    output.log(returncode)
+    return returncode == 0, output.paths('failed')
+
+async def csync_check_and_push_async(csync_opts, paths, nodes, report=True):
+    # Check the paths in argv-sized chunks, one after another. Every checked
+    # chunk is published to the per-node pipelines, so pushes start after
+    # the first chunk and overlap the remaining checks. csync2 retries on a
+    # busy database, so -cr and -ub can share it.
+    chunks = chunk_paths(["csync2", *csync_opts, "-cr"], paths)
+    await replication.wait_for_capacity()
+
+    timings = []
+    failed = 0
+    for chunk in chunks:
+        if shutdown_flag:
+            break
+        overlap = replication.overlapping_generation(chunk)
+        if overlap:
+            logger.debug(f"Chunk shares paths with in-flight push {overlap}, waiting for it")
+            await replication.wait_for_generation(overlap)
+        start = time.time()
+        ok, failed_paths = await csync_check_chunk_async(csync_opts, chunk)
+        timings.append(time.time() - start)
+        if not ok:
+            failed += 1
+            # Only the paths csync2 named are retried, the whole chunk when
+            # it named none
+            retries.fail(None, failed_paths or chunk)
+            failed_paths = set(failed_paths)
+            chunk = [path for path in chunk if path not in failed_paths]
+            if not failed_paths or not chunk:
+                continue
+        retries.succeed(None, chunk)
+        replication.publish(chunk)
+        if snapshot is not None:
+            snapshot.refresh(chunk)
+
+    if report:
+        log_chunk_report(paths, timings, failed)
+    return {'chunks': len(chunks), 'timings': timings, 'failed': failed, 'checked': len(timings) - failed}
 
 async def update_node_async(node, csync_opts):
+    output = SyncOutput("csync2", f"update {node}")
     try:
-        logger.debug(f"Updating node {node}")
-        process = await asyncio.create_subprocess_exec(
-            "csync2", *csync_opts, "-ub", "-P", node,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        logger.debug(f"Node {node} update result: {stdout.decode()}")
-        if stderr:
-            logger.error(f"Error updating node {node}: {stderr.decode()}")
+        async with limiter.slot(node):
+            logger.debug(f"Updating node {node}")
+            start = time.time()
+            returncode = await run_sync_command(["csync2", *csync_opts, "-ub", "-P", node], output)
     except Exception as e:
         logger.error(f"Exception while updating node {node}: {e}")
+        metrics.inc('csync_pushes', tool="csync2", node=node, status="error")
+        return False
+    record_push_metrics("csync2", node, time.time() - start, returncode)
+    output.log(returncode)
+    retries.record_push(node, output, returncode)
+    return returncode == 0
+
+class SshPool:
+    # One multiplexed SSH master connection per node, owned by this process.
+    # rsync reaches a node through "ssh -o ControlPath=<socket>", so a
+    # transfer only opens a channel on the existing session instead of a
+    # full handshake. A client that finds no master falls back to a direct
+    # connection, hence starting a master never blocks a transfer. A
+    # maintenance thread restarts masters that fail "ssh -O check" and
+    # closes masters that were not used for ssh_idle_timeout seconds; they
+    # are opened again on the next use, or node_retry_delay seconds after
+    # a master failed. rsh() runs on the event loop, so the lock is never
+    # held while waiting for an ssh command: masters are detached under the
+    # lock and checked or shut down outside it.
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.lock = threading.Lock()
+        self.masters = {}  # node -> ssh master process
+        self.last_used = {}
+        self.failed = {}  # node -> time its master last exited
+        self.started = collections.Counter()
+        self._thread = None
+        os.makedirs(ssh_control_dir, mode=0o700, exist_ok=True)
+
+    def socket(self, node):
+        return os.path.join(ssh_control_dir, f"{node}.sock")
+
+    def _control(self, node, *args):
+        return [*ssh_command, "-o", f"ControlPath={self.socket(node)}", *args, node]
+
+    def _start(self, node):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket(node))
+        cmd = self._control(node, "-M", "-N", "-o", "ControlPersist=no", "-o", "BatchMode=yes",
+                            "-o", f"ConnectTimeout={ssh_connect_timeout}", "-o", "ServerAliveInterval=15")
+        try:
+            self.masters[node] = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as e:
+            logger.error(f"Cannot start SSH master for {node}: {e}")
+            return
+        self.started[node] += 1
+        logger.debug(f"Started SSH master for {node}")
+
+    def _stop(self, node, process):
+        if process is None:
+            return
+        if process.poll() is None:
+            with contextlib.suppress(subprocess.TimeoutExpired):
+                subprocess.run(self._control(node, "-O", "exit"), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               timeout=ssh_connect_timeout)
+        if process.poll() is None:
+            process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stderr.close()
+
+    def _alive(self, node):
+        process = self.masters.get(node)
+        if process is None:
+            return False
+        if process.poll() is not None:
+            error = process.stderr.read().decode(errors='replace').strip()
+            logger.warning(f"SSH master for {node} exited with status {process.returncode}" + (f": {error}" if error else ""))
+            self.failed[node] = time.time()
+            # Already exited, so stopping it does not wait
+            self._stop(node, self.masters.pop(node))
+            return False
+        return True
+
+    def _healthy(self, node):
+        try:
+            return subprocess.run(self._control(node, "-O", "check"), stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, timeout=ssh_connect_timeout).returncode == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    def rsh(self, node):
+        # The rsync -e command for node, starting its master if needed
+        with self.lock:
+            self.last_used[node] = time.time()
+            if not self._alive(node) and time.time() - self.failed.get(node, 0) >= node_retry_delay:
+                self._start(node)
+        return shlex.join([*ssh_command, "-o", "ControlMaster=no", "-o", f"ControlPath={self.socket(node)}"])
+
+    def warm_up(self):
+        start = time.time()
+        with self.lock:
+            for node in self.nodes:
+                self.last_used[node] = start
+                self._start(node)
+        deadline = start + ssh_connect_timeout
+        waiting = set(self.nodes)
+        while waiting and time.time() < deadline and not shutdown_flag:
+            with self.lock:
+                waiting = {node for node in waiting if self._alive(node) and not os.path.exists(self.socket(node))}
+            time.sleep(0.1)
+        ready = [node for node in self.nodes if os.path.exists(self.socket(node))]
+        logger.info(f"SSH masters ready for {len(ready)}/{len(self.nodes)} nodes in {time.time() - start:.2f}s")
+
+    def maintain(self):
+        now = time.time()
+        idle, check = [], []
+        with self.lock:
+            for node in list(self.masters):
+                if now - self.last_used.get(node, 0) > ssh_idle_timeout:
+                    idle.append((node, self.masters.pop(node)))
+                elif self._alive(node) and os.path.exists(self.socket(node)):
+                    check.append((node, self.masters[node]))
+        for node, process in idle:
+            logger.debug(f"Closing idle SSH master for {node}")
+            self._stop(node, process)
+        for node, process in check:
+            if self._healthy(node):
+                continue
+            logger.warning(f"SSH master for {node} failed its health check, restarting it")
+            with self.lock:
+                # rsh() may have replaced it meanwhile
+                if self.masters.get(node) is not process:
+                    continue
+                del self.masters[node]
+            self._stop(node, process)
+            with self.lock:
+                if node not in self.masters:
+                    self._start(node)
+
+    def run(self):
+        interval = min(30, ssh_idle_timeout / 2)
+        while not shutdown_flag:
+            deadline = time.time() + interval
+            while time.time() < deadline and not shutdown_flag:
+                time.sleep(0.5)
+            if not shutdown_flag:
+                self.maintain()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="ssh-pool", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self.lock:
+            masters, self.masters = self.masters, {}
+        for node, process in masters.items():
+            self._stop(node, process)
+        if self.started:
+            logger.info(f"SSH masters closed, masters started per node: {dict(self.started)}")
+
+def open_ssh_pool(nodes):
+    global ssh_pool
+    if use_rsync and use_ssh_pool:
+        try:
+            ssh_pool = SshPool(nodes)
+        except OSError as e:
+            logger.error(f"Cannot create SSH control directory {ssh_control_dir}: {e}")
+            return None
+        ssh_pool.warm_up()
+        ssh_pool.start()
+    return ssh_pool
+
+def close_ssh_pool():
+    if ssh_pool is not None:
+        ssh_pool.close()
+
+def rsync_file_lists(includes, paths):
+    # Splits a batch by include root into paths that still exist and paths
+    # that were deleted, relative to the root as --files-from expects them
+    lists = {}
+    for include in includes:
+        head = include.rstrip('/') + '/'
+        present, missing = [], []
+        for path in paths:
+            if path == include or path.startswith(head):
+                relative = os.fsencode(os.path.relpath(path, include))
+                (present if os.path.lexists(path) else missing).append(relative)
+        if present or missing:
+            lists[include] = (present, missing)
+    return lists
+
+def rsync_transfers(node, include, lists=None):
+    # (label, command, stdin) of the rsync runs that replicate one include
+    # root to node: the whole tree, or exactly the listed paths with the
+    # deletions in a run of their own. -r is given explicitly because
+    # --files-from turns off the recursion implied by -a, and --delete
+    # only applies inside listed directories, not to the parents of
+    # listed files.
+    source = include.rstrip('/') + '/'
+    dest = f"{node}:{source}"
+    options = rsync_node_options.get(node, rsync_options)
+    base = ["rsync", "-ai", "--info=stats1", *options]
+    if ssh_pool is not None:
+        base += ["-e", ssh_pool.rsh(node)]
+    if lists is None:
+        return [("tree", base + ["--delete", source, dest], None)]
+    present, missing = lists
+    transfers = []
+    if present:
+        transfers.append((f"{len(present)} paths", base + ["-r", "--delete", "--files-from=-", "--from0", source, dest],
+                          b'\0'.join(present)))
+    if missing:
+        transfers.append((f"{len(missing)} deletions", base + ["-r", "--delete-missing-args", "--force", "--files-from=-", "--from0", source, dest],
+                          b'\0'.join(missing)))
+    return transfers
+
+def rsync_failed_paths(include, output, returncode, stdin_data):
+    # rsync names files relative to the include root, or by their source
+    # path. A run that failed without naming any (ssh unreachable,
+    # protocol error) is retried with every path it was given.
+    failed = [os.path.normpath(os.path.join(include, path)) for path in output.paths('failed')]
+    if returncode != 0 and not failed:
+        if stdin_data is None:
+            return [include]
+        failed = [os.path.normpath(os.path.join(include, os.fsdecode(path))) for path in stdin_data.split(b'\0') if path]
+    return failed
+
+def rsync_transferred(jobs, results, paths):
+    # Paths of the include roots that every node received
+    failed = [include.rstrip('/') for (_, include, _), ok in zip(jobs, results) if not ok]
+    return [path for path in paths if not any(path == i or path.startswith(i + '/') for i in failed)]
+
+def rsync_jobs(includes, nodes, csync_files):
+    if rsync_mode == "tree":
+        return [(node, include, None) for node in nodes for include in includes]
+    lists = rsync_file_lists(includes, csync_files)
+    return [(node, include, lists[include]) for node in nodes for include in lists]
 
 async def process_changes_async(csync_opts, includes, nodes, csync_files):
-    csync_server_wait()
+    latency_tracker.assign(csync_files)
+    if snapshot is not None:
+        snapshot.assign(csync_files)
+    await server_monitor.wait_ready()
     if shutdown_flag:
         return
 
     if use_rsync and len(csync_files) >= rsync_threshold:
         logger.info(f"Using rsync for large batch: {len(csync_files)} files")
-        rsync_tasks = [rsync_update_async(node, include, include) for node in nodes for include in includes]
-        await asyncio.gather(*rsync_tasks)
+        transfer = latency_tracker.publish_transfer(csync_files)
+        jobs = rsync_jobs(includes, nodes, csync_files)
+        results = await asyncio.gather(*[rsync_update_async(*job, transfer=transfer) for job in jobs])
+        latency_tracker.finish_transfer(transfer)
+        if snapshot is not None:
+            snapshot.refresh(rsync_transferred(jobs, results, csync_files))
     else:
-        try:
-            logger.debug(f"Processing {len(csync_files)} files with csync2")
-            process = await asyncio.create_subprocess_exec(
-                "csync2", *csync_opts, "-cr", *csync_files,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            logger.debug(f"Csync2 process result: {stdout.decode()}")
-            if stderr:
-                logger.error(f"Csync2 process error: {stderr.decode()}")
-        except Exception as e:
-            logger.error(f"Error during csync2 process: {e}")
-            return
-        
-        update_tasks = [update_node_async(node, csync_opts) for node in nodes]
-        await asyncio.gather(*update_tasks)
+        logger.debug(f"Processing {len(csync_files)} files with csync2")
+        await csync_check_and_push_async(csync_opts, csync_files, nodes)
 
+    limiter.report()
     logger.info("  Done")
 
-async def rsync_update_async(node, source_path, dest_path):
-    try:
-        logger.debug(f"Rsyncing from {source_path} to {node}:{dest_path}")
-        process = await asyncio.create_subprocess_exec(
-            "rsync", "-avz", "--delete", source_path, f"{node}:{dest_path}",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        logger.debug(f"Rsync result: {stdout.decode()}")
-        if stderr:
-            logger.error(f"Rsync error: {stderr.decode()}")
-    except Exception as e:
-        logger.error(f"Exception during rsync: {e}")
+async def rsync_update_async(node, include, lists=None, transfer=None):
+    ok = True
+    for label, cmd, stdin_data in rsync_transfers(node, include, lists):
+        output = SyncOutput("rsync", f"{node}:{include} ({label})")
+        try:
+            async with limiter.slot(node):
+                logger.debug(f"Rsyncing {include} to {node} ({label})")
+                start = time.time()
+                returncode = await run_sync_command(cmd, output, stdin_data)
+        except Exception as e:
+            logger.error(f"Exception during rsync: {e}")
+            metrics.inc('csync_pushes', tool="rsync", node=node, status="error")
+            retries.fail(node, rsync_failed_paths(include, output, 1, stdin_data))
+            return False
+        record_push_metrics("rsync", node, time.time() - start, returncode)
+        metrics.inc('csync_rsync_sent_bytes', output.sent_bytes, node=node)
+        output.log(returncode)
+        retries.fail(node, rsync_failed_paths(include, output, returncode, stdin_data))
+        ok = ok and returncode == 0
+    if ok and transfer is not None:
+        latency_tracker.transferred(transfer, node, include)
+    return ok
 
 def parse_config_file(config_file):
     nodes, includes, excludes = [], [], []
@@ -209,7 +3255,7 @@ def parse_config_file(config_file):
     return nodes, includes, excludes
 
 async def run_async(csync_opts):
-    global nodes, includes, excludes, config_file, shutdown_flag
+    global nodes, includes, excludes, config_file, shutdown_flag, exclude_matcher, replication, limiter, server_monitor, retries, rescans, latency_tracker
 
     nodes, includes, excludes = parse_config_file(config_file)
 
@@ -217,29 +3263,50 @@ async def run_async(csync_opts):
         logger.error("No nodes or includes found in config file")
         return
 
-    event_queue = asyncio.Queue()
-    wm = pyinotify.WatchManager()
-    mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE | pyinotify.IN_MODIFY | \
-           pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | \
-           pyinotify.IN_ATTRIB
-    handler = ChangeEventHandler(event_queue)
-    notifier = pyinotify.AsyncioNotifier(wm, asyncio.get_event_loop(), default_proc_fun=handler)
+    exclude_matcher = ExcludeMatcher(excludes)
+    if exclude_matcher:
+        logger.info(f"Loaded {exclude_matcher.count} exclude patterns")
 
-    for include_path in includes:
+    event_queue = asyncio.Queue()
+    open_journal()
+    open_snapshot()
+    open_ssh_pool(nodes)
+    open_trace(includes)
+    open_metrics()
+    if watcher_backend == "fanotify":
         try:
-            if not os.path.exists(include_path):
-                logger.warning(f"Directory does not exist: {include_path}. Creating it.")
-                os.makedirs(include_path, exist_ok=True)
-            wm.add_watch(include_path, mask, rec=True, auto_add=True)
-        except pyinotify.WatchManagerError as e:
-            logger.error(f"Error adding watch for {include_path}: {e}")
+            notifier = FanotifyWatcher(includes, WATCH_MASK, exclude_filter=exclude_matcher or None)
+        except OSError as e:
+            logger.error(f"Cannot start fanotify watcher (needs CAP_SYS_ADMIN and Linux 5.9+): {e}")
+            return
+        notifier.start_async(asyncio.get_running_loop(), event_queue.put_nowait)
+    elif watcher_backend == "native":
+        notifier = NativeInotify(WATCH_MASK, exclude_filter=exclude_matcher or None)
+        catch_up = add_include_watches(notifier, includes, WATCH_MASK, exclude_matcher or None)
+        if catch_up:
+            event_queue.put_nowait(catch_up)
+        notifier.start_async(asyncio.get_running_loop(), event_queue.put_nowait)
+    else:
+        wm = pyinotify.WatchManager()
+        handler = ChangeEventHandler(event_queue, exclude_matcher or None)
+        notifier = pyinotify.AsyncioNotifier(wm, asyncio.get_running_loop(), default_proc_fun=handler)
+        add_include_watches(wm, includes, WATCH_MASK, exclude_matcher or None)
+    logger.info(f"Using {watcher_backend} watcher backend")
 
     csync_server = await asyncio.create_subprocess_exec(
         "csync2", "-ii", "-t", *csync_opts,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.STDOUT
     )
-
+    server_monitor = CsyncServerMonitor(server_idle_timeout)
+    monitor_task = asyncio.create_task(server_monitor.run(csync_server.stdout))
+
+    retries = RetryTracker()
+    rescans = RescanQueue(includes)
+    limiter = ConcurrencyLimiter(nodes, parallel_updates, per_node_updates)
+    latency_tracker = LatencyTracker(nodes, includes)
+    replication = ReplicationPipelines(nodes, csync_opts)
+    replication.start()
     queue_task = asyncio.create_task(process_queue_async(event_queue, csync_opts, includes, nodes))
 
     def signal_handler():
@@ -254,50 +3321,76 @@ async def run_async(csync_opts):
     loop.add_signal_handler(signal.SIGTERM, signal_handler)
 
     try:
-        await asyncio.gather(csync_server.wait(), queue_task)
+        await asyncio.gather(csync_server.wait(), queue_task, monitor_task)
     except asyncio.CancelledError:
         logger.info("Tasks cancelled. Shutting down...")
     finally:
         notifier.stop()
+        replication.stop()
+        close_journal(event_queue)
+        close_snapshot()
+        close_ssh_pool()
+        close_trace()
+        close_metrics()
         logger.info("Shutdown complete.")
 
 async def process_queue_async(queue, csync_opts, includes, nodes):
     global queue_line_pos, last_full_sync, shutdown_flag
-    last_process_time = time.time()
-    pending_files = set()
+    pending_changes = EventCoalescer()
+    scheduler = FlushScheduler()
+    replay_journal(pending_changes)
+    if pending_changes:
+        scheduler.observe(len(pending_changes))
+    catch_up = not last_full_sync
+    if snapshot is not None and snapshot.complete:
+        ingest_events(await asyncio.to_thread(snapshot.diff, includes), pending_changes, scheduler)
+        catch_up = False
+    reconciler = RollingFullSync(includes, catch_up=catch_up)
 
     while not shutdown_flag:
         try:
-            file_path = await asyncio.wait_for(queue.get(), timeout=min(check_interval, max_wait_time - (time.time() - last_process_time)))
-            pending_files.add(file_path)
+            events = await asyncio.wait_for(queue.get(), timeout=scheduler.timeout())
+            ingest_watcher_events(events, pending_changes, scheduler)
+            while not queue.empty():
+                ingest_watcher_events(queue.get_nowait(), pending_changes, scheduler)
         except asyncio.TimeoutError:
-            if shutdown_flag:
-                break
-            if time.time() - last_process_time >= max_wait_time and pending_files:
-                logger.info(f"* PROCESSING QUEUE (line {queue_line_pos})")
-                queue_line_pos += len(pending_files)
-                csync_files = list(pending_files)
-                pending_files.clear()
-
-                if len(csync_files) >= num_batched_changes_threshold:
-                    logger.info(f"* LARGE BATCH ({len(csync_files)}) files")
-                    await csync_full_sync(csync_opts, includes, nodes)
-                else:
-                    await process_changes_async(csync_opts, includes, nodes, csync_files)
-
-                last_process_time = time.time()
-            elif queue_line_pos >= num_lines_until_reset:
-                reset_queue()
-            elif time.time() - last_full_sync > full_sync_interval:
-                await csync_full_sync(csync_opts, includes, nodes)
+            pass
         except asyncio.CancelledError:
             logger.info("Queue processing cancelled.")
             break
+        if shutdown_flag:
+            break
+        if event_journal is not None:
+            event_journal.maybe_commit()
+        requeue_retries(pending_changes, scheduler)
+        latency_tracker.report()
+
+        reason = scheduler.due(len(pending_changes))
+        if reason:
+            csync_files, journal_offset = take_batch(pending_changes, scheduler, includes, reason)
+            if len(csync_files) >= num_batched_changes_threshold:
+                subtrees = coarsen_paths(csync_files, includes)
+                logger.info(f"* LARGE BATCH ({len(csync_files)}) files, checking {len(subtrees)} subtrees")
+                await process_changes_async(csync_opts, includes, nodes, subtrees)
+            elif csync_files:
+                await process_changes_async(csync_opts, includes, nodes, csync_files)
+            if event_journal is not None:
+                event_journal.ack(journal_offset)
+        if rescans:
+            # Rescans take turns with the batches so that lost events are
+            # recovered under sustained load too; each turn is bounded
+            await rescan_subtrees_async(pending_changes, scheduler)
+        elif reason or pending_changes:
+            continue
+        elif queue_line_pos >= num_lines_until_reset:
+            reset_queue()
+        elif reconciler.due():
+            await csync_full_sync(csync_opts, nodes, reconciler, lambda: not queue.empty())
     
     logger.info("Queue processing stopped.")
 
 def run_threaded(csync_opts):
-    global nodes, includes, excludes, config_file, shutdown_flag
+    global nodes, includes, excludes, config_file, shutdown_flag, exclude_matcher, replication, limiter, server_monitor, retries, rescans, latency_tracker
 
     nodes, includes, excludes = parse_config_file(config_file)
 
@@ -305,45 +3398,65 @@ def run_threaded(csync_opts):
         logger.error("No nodes or includes found in config file")
         return
 
-    event_queue = queue.Queue()
-    wm = pyinotify.WatchManager()
-    mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE | pyinotify.IN_MODIFY | \
-           pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | \
-           pyinotify.IN_ATTRIB
-    handler = ChangeEventHandler(event_queue)
-    notifier = pyinotify.ThreadedNotifier(wm, handler)
-    notifier.start()
+    exclude_matcher = ExcludeMatcher(excludes)
+    if exclude_matcher:
+        logger.info(f"Loaded {exclude_matcher.count} exclude patterns")
 
-    for include_path in includes:
+    event_queue = queue.Queue()
+    open_journal()
+    open_snapshot()
+    open_ssh_pool(nodes)
+    open_trace(includes)
+    open_metrics()
+    if watcher_backend == "fanotify":
         try:
-            if not os.path.exists(include_path):
-                logger.warning(f"Directory does not exist: {include_path}. Creating it.")
-                os.makedirs(include_path, exist_ok=True)
-            wm.add_watch(include_path, mask, rec=True, auto_add=True)
-        except pyinotify.WatchManagerError as e:
-            logger.error(f"Error adding watch for {include_path}: {e}")
+            notifier = FanotifyWatcher(includes, WATCH_MASK, exclude_filter=exclude_matcher or None)
+        except OSError as e:
+            logger.error(f"Cannot start fanotify watcher (needs CAP_SYS_ADMIN and Linux 5.9+): {e}")
+            return
+        notifier.start_thread(event_queue.put)
+    elif watcher_backend == "native":
+        notifier = NativeInotify(WATCH_MASK, exclude_filter=exclude_matcher or None)
+        catch_up = add_include_watches(notifier, includes, WATCH_MASK, exclude_matcher or None)
+        if catch_up:
+            event_queue.put(catch_up)
+        notifier.start_thread(event_queue.put)
+    else:
+        wm = pyinotify.WatchManager()
+        handler = ChangeEventHandler(event_queue, exclude_matcher or None)
+        notifier = pyinotify.ThreadedNotifier(wm, handler)
+        notifier.start()
+        add_include_watches(wm, includes, WATCH_MASK, exclude_matcher or None)
+    logger.info(f"Using {watcher_backend} watcher backend")
 
     try:
         csync_server = subprocess.Popen(["csync2", "-ii", "-t"] + csync_opts, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     except subprocess.SubprocessError as e:
         logger.error(f"Error starting csync2 server: {e}")
         return
-
-    process_queue_thread = threading.Thread(target=process_queue_thread, args=(event_queue, csync_opts, includes, nodes))
-    process_queue_thread.start()
-
-    def signal_handler():
+    server_monitor = CsyncServerMonitor(server_idle_timeout, threaded=True)
+    monitor_thread = threading.Thread(target=server_monitor.run_thread, args=(csync_server.stdout,), daemon=True)
+    monitor_thread.start()
+
+    retries = RetryTracker()
+    rescans = RescanQueue(includes)
+    limiter = ConcurrencyLimiter(nodes, parallel_updates, per_node_updates, threaded=True)
+    latency_tracker = LatencyTracker(nodes, includes)
+    replication = ReplicationPipelines(nodes, csync_opts, threaded=True)
+    replication.start()
+    queue_thread = threading.Thread(target=process_queue_thread, args=(event_queue, csync_opts, includes, nodes))
+    queue_thread.start()
+
+    def signal_handler(signum=None, frame=None):
         global shutdown_flag
         logger.info("Received shutdown signal. Initiating graceful shutdown...")
         shutdown_flag = True
-        queue_task.cancel()
 
-        # Safely terminate the subprocess, check if transport exists
-        if csync_server._transport is None or csync_server._transport.is_closing():
-            logger.info("Csync2 server process already terminated or never started.")
+        if csync_server.poll() is not None:
+            logger.info("Csync2 server process already terminated.")
         else:
             try:
-                csync_server.terminate()  # This safely terminates the subprocess
+                csync_server.terminate()
                 logger.info("Csync2 server terminated.")
             except ProcessLookupError:
                 logger.info("Csync2 server process not found. It might have already been terminated.")
@@ -359,113 +3472,208 @@ def run_threaded(csync_opts):
         shutdown_flag = True
     finally:
         notifier.stop()
-        process_queue_thread.join()
+        queue_thread.join()
+        replication.stop()
+        close_journal(event_queue)
+        close_snapshot()
+        close_ssh_pool()
+        close_trace()
+        close_metrics()
         csync_server.wait()
         logger.info("Shutdown complete.")
 
-def process_queue_thread(queue, csync_opts, includes, nodes):
+def process_queue_thread(event_queue, csync_opts, includes, nodes):
     global queue_line_pos, last_full_sync, shutdown_flag
-    last_process_time = time.time()
-    pending_files = set()
+    pending_changes = EventCoalescer()
+    scheduler = FlushScheduler()
+    replay_journal(pending_changes)
+    if pending_changes:
+        scheduler.observe(len(pending_changes))
+    catch_up = not last_full_sync
+    if snapshot is not None and snapshot.complete:
+        ingest_events(snapshot.diff(includes), pending_changes, scheduler)
+        catch_up = False
+    reconciler = RollingFullSync(includes, catch_up=catch_up)
 
     while not shutdown_flag:
         try:
-            file_path = queue.get(timeout=min(check_interval, max_wait_time - (time.time() - last_process_time)))
-            pending_files.add(file_path)
+            events = event_queue.get(timeout=scheduler.timeout())
+            ingest_watcher_events(events, pending_changes, scheduler)
+            while not event_queue.empty():
+                ingest_watcher_events(event_queue.get_nowait(), pending_changes, scheduler)
         except queue.Empty:
-            if shutdown_flag:
-                break
-            if time.time() - last_process_time >= max_wait_time and pending_files:
-                logger.info(f"* PROCESSING QUEUE (line {queue_line_pos})")
-                queue_line_pos += len(pending_files)
-                csync_files = list(pending_files)
-                pending_files.clear()
-
-                if len(csync_files) >= num_batched_changes_threshold:
-                    logger.info(f"* LARGE BATCH ({len(csync_files)}) files")
-                    csync_full_sync_threaded(csync_opts, includes, nodes)
-                else:
-                    process_changes_threaded(csync_opts, includes, nodes, csync_files)
-
-                last_process_time = time.time()
-            elif queue_line_pos >= num_lines_until_reset:
-                reset_queue()
-            elif time.time() - last_full_sync > full_sync_interval:
-                csync_full_sync_threaded(csync_opts, includes, nodes)
+            pass
+        if shutdown_flag:
+            break
+        if event_journal is not None:
+            event_journal.maybe_commit()
+        requeue_retries(pending_changes, scheduler)
+        latency_tracker.report()
+
+        reason = scheduler.due(len(pending_changes))
+        if reason:
+            csync_files, journal_offset = take_batch(pending_changes, scheduler, includes, reason)
+            if len(csync_files) >= num_batched_changes_threshold:
+                subtrees = coarsen_paths(csync_files, includes)
+                logger.info(f"* LARGE BATCH ({len(csync_files)}) files, checking {len(subtrees)} subtrees")
+                process_changes_threaded(csync_opts, includes, nodes, subtrees)
+            elif csync_files:
+                process_changes_threaded(csync_opts, includes, nodes, csync_files)
+            if event_journal is not None:
+                event_journal.ack(journal_offset)
+        if rescans:
+            # Rescans take turns with the batches so that lost events are
+            # recovered under sustained load too; each turn is bounded
+            rescan_subtrees(pending_changes, scheduler)
+        elif reason or pending_changes:
+            continue
+        elif queue_line_pos >= num_lines_until_reset:
+            reset_queue()
+        elif reconciler.due():
+            csync_full_sync_threaded(csync_opts, nodes, reconciler, lambda: not event_queue.empty())
     
     logger.info("Queue processing stopped.")
 
 def update_node_threaded(node, csync_opts):
     if shutdown_flag:
-        return
-    try:
-        logger.debug(f"Updating node {node}")
-        result = subprocess.run(["csync2"] + csync_opts + ["-ub", "-P", node], 
-                                check=True, capture_output=True, text=True)
-        logger.debug(f"Node {node} update result: {result.stdout}")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error updating node {node}: {e}")
-        logger.error(f"Command output: {e.output}")
-
-def rsync_update_threaded(node, source_path, dest_path):
-    if shutdown_flag:
-        return
+        return False
+    output = SyncOutput("csync2", f"update {node}")
     try:
-        logger.debug(f"Rsyncing from {source_path} to {node}:{dest_path}")
-        result = subprocess.run(["rsync", "-avz", "--delete", source_path, f"{node}:{dest_path}"], 
-                                check=True, capture_output=True, text=True)
-        logger.debug(f"Rsync result: {result.stdout}")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Rsync error: {e}")
-        logger.error(f"Command output: {e.output}")
-
-def csync_full_sync_threaded(csync_opts, includes, nodes):
+        with limiter.slot_threaded(node):
+            logger.debug(f"Updating node {node}")
+            start = time.time()
+            returncode = run_sync_command_threaded(["csync2"] + csync_opts + ["-ub", "-P", node], output)
+    except OSError as e:
+        logger.error(f"Exception while updating node {node}: {e}")
+        metrics.inc('csync_pushes', tool="csync2", node=node, status="error")
+        return False
+    record_push_metrics("csync2", node, time.time() - start, returncode)
+    output.log(returncode)
+    retries.record_push(node, output, returncode)
+    return returncode == 0
+
+def rsync_update_threaded(node, include, lists=None, transfer=None):
+    ok = True
+    for label, cmd, stdin_data in rsync_transfers(node, include, lists):
+        if shutdown_flag:
+            return
+        output = SyncOutput("rsync", f"{node}:{include} ({label})")
+        try:
+            with limiter.slot_threaded(node):
+                logger.debug(f"Rsyncing {include} to {node} ({label})")
+                start = time.time()
+                returncode = run_sync_command_threaded(cmd, output, stdin_data)
+        except OSError as e:
+            logger.error(f"Rsync error: {e}")
+            metrics.inc('csync_pushes', tool="rsync", node=node, status="error")
+            retries.fail(node, rsync_failed_paths(include, output, 1, stdin_data))
+            return False
+        record_push_metrics("rsync", node, time.time() - start, returncode)
+        metrics.inc('csync_rsync_sent_bytes', output.sent_bytes, node=node)
+        output.log(returncode)
+        retries.fail(node, rsync_failed_paths(include, output, returncode, stdin_data))
+        ok = ok and returncode == 0
+    if ok and transfer is not None:
+        latency_tracker.transferred(transfer, node, include)
+    return ok
+
+def csync_full_sync_threaded(csync_opts, nodes, reconciler, preempted):
     global last_full_sync
-    if shutdown_flag:
-        return
-    logger.info("* FULL SYNC")
-
-    csync_server_wait()
-
+    server_monitor.wait_ready_threaded()
+
+    start = time.time()
+    shards = paths = 0
+    complete = False
+    while not (shutdown_flag or complete or preempted()) and time.time() - start < full_sync_budget and reconciler.due():
+        shard = reconciler.take()
+        shard_start = time.time()
+        csync_check_and_push_threaded(csync_opts, shard, nodes, report=False)
+        complete = reconciler.finished(shard, time.time() - shard_start)
+        shards += 1
+        paths += len(shard)
+
+    if shards:
+        logger.info(f"* FULL SYNC tick: {shards} shard(s), {paths} paths in {time.time() - start:.2f}s, {len(reconciler.shards)} left")
+        metrics.observe('csync_full_sync_tick_seconds', time.time() - start)
+        limiter.report()
+    if complete:
+        last_full_sync = time.time()
+        metrics.set('csync_last_full_sync_timestamp_seconds', last_full_sync)
+        if snapshot is not None:
+            snapshot.mark_complete()
+
+def csync_check_chunk_threaded(csync_opts, chunk):
+    output = SyncOutput("csync2", "check")
     try:
-        logger.debug("Running csync2 check")
-        result = subprocess.run(["csync2"] + csync_opts + ["-cr"] + includes, 
-                                check=True, capture_output=True, text=True)
-        logger.debug(f"Csync2 check result: {result.stdout}")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Csync2 check error: {e}")
-        logger.error(f"Command output: {e.output}")
-        return
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-        list(executor.map(lambda node: update_node_threaded(node, csync_opts), nodes))
-
-    last_full_sync = time.time()
-    logger.info("  Done")
+        with limiter.slot_threaded():
+            start = time.time()
+            returncode = run_sync_command_threaded(["csync2"] + csync_opts + ["-cr"] + chunk, output)
+    except OSError as e:
+        logger.error(f"Error during csync2 check: {e}")
+        metrics.inc('csync_checks', status="error")
+        return False, []
+    metrics.observe('csync_check_seconds', time.time() - start)
+    metrics.inc('csync_checks', status=returncode)
+    output.log(returncode)
+    return returncode == 0, output.paths('failed')
+
+def csync_check_and_push_threaded(csync_opts, paths, nodes, report=True):
+    # Threaded counterpart of csync_check_and_push_async
+    chunks = chunk_paths(["csync2"] + csync_opts + ["-cr"], paths)
+    replication.wait_for_capacity_threaded()
+
+    timings = []
+    failed = 0
+    for chunk in chunks:
+        if shutdown_flag:
+            break
+        overlap = replication.overlapping_generation(chunk)
+        if overlap:
+            logger.debug(f"Chunk shares paths with in-flight push {overlap}, waiting for it")
+            replication.wait_for_generation_threaded(overlap)
+        start = time.time()
+        ok, failed_paths = csync_check_chunk_threaded(csync_opts, chunk)
+        timings.append(time.time() - start)
+        if not ok:
+            failed += 1
+            # Only the paths csync2 named are retried, the whole chunk when
+            # it named none
+            retries.fail(None, failed_paths or chunk)
+            failed_paths = set(failed_paths)
+            chunk = [path for path in chunk if path not in failed_paths]
+            if not failed_paths or not chunk:
+                continue
+        retries.succeed(None, chunk)
+        replication.publish(chunk)
+        if snapshot is not None:
+            snapshot.refresh(chunk)
+
+    if report:
+        log_chunk_report(paths, timings, failed)
+    return {'chunks': len(chunks), 'timings': timings, 'failed': failed, 'checked': len(timings) - failed}
 
 def process_changes_threaded(csync_opts, includes, nodes, csync_files):
+    latency_tracker.assign(csync_files)
+    if snapshot is not None:
+        snapshot.assign(csync_files)
     if shutdown_flag:
         return
-    csync_server_wait()
+    server_monitor.wait_ready_threaded()
 
     if use_rsync and len(csync_files) >= rsync_threshold:
         logger.info(f"Using rsync for large batch: {len(csync_files)} files")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-            list(executor.map(lambda args: rsync_update_threaded(*args), 
-                         [(node, include, include) for node in nodes for include in includes]))
+        transfer = latency_tracker.publish_transfer(csync_files)
+        jobs = rsync_jobs(includes, nodes, csync_files)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(jobs), parallel_updates or len(jobs)))) as executor:
+            results = list(executor.map(lambda args: rsync_update_threaded(*args, transfer=transfer), jobs))
+        latency_tracker.finish_transfer(transfer)
+        if snapshot is not None:
+            snapshot.refresh(rsync_transferred(jobs, results, csync_files))
     else:
-        try:
-            logger.debug(f"Processing {len(csync_files)} files with csync2")
-            result = subprocess.run(["csync2"] + csync_opts + ["-cr"] + csync_files, 
-                                    check=True, capture_output=True, text=True)
-            logger.debug(f"Csync2 process result: {result.stdout}")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Csync2 process error: {e}")
-            logger.error(f"Command output: {e.output}")
-            return
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-            list(executor.map(lambda node: update_node_threaded(node, csync_opts), nodes))
+        logger.debug(f"Processing {len(csync_files)} files with csync2")
+        csync_check_and_push_threaded(csync_opts, csync_files, nodes)
+
+    limiter.report()
 
     logger.info("  Done")
 
@@ -474,13 +3682,47 @@ if __name__ == "__main__":
     parser.add_argument('--config', type=str, default="/etc/csync2/csync2.cfg", help='Path to csync2 config file')
     parser.add_argument('--check-interval', type=float, default=0.5, help='Interval between queue checks')
     parser.add_argument('--full-sync-interval', type=int, default=3600, help='Interval between full syncs')
+    parser.add_argument('--full-sync-budget', type=float, default=5.0, help='Seconds of full sync checking per tick before incremental batches get a turn')
+    parser.add_argument('--shard-files', type=int, default=1000, help='Files per full sync shard in directories that are split')
     parser.add_argument('--num-lines-until-reset', type=int, default=200000, help='Number of lines until queue reset')
     parser.add_argument('--num-batched-changes-threshold', type=int, default=15000, help='Threshold for batch processing')
     parser.add_argument('--rsync-threshold', type=int, default=5000, help='Threshold for using rsync instead of csync2')
-    parser.add_argument('--parallel-updates', type=int, default=1, help='Enable parallel updates')
-    parser.add_argument('--max-wait-time', type=int, default=10, help='Maximum wait time before processing queue')
+    parser.add_argument('--collapse-min-children', type=int, default=200, help='Replace changed children with their directory once this many changed (0 to disable)')
+    parser.add_argument('--collapse-ratio', type=float, default=0.5, help='Replace changed children with their directory once this share of its entries changed (0 to disable)')
+    parser.add_argument('--max-argv-bytes', type=int, default=0, help='Cap on argv bytes per csync2 -cr call (0 derives it from ARG_MAX)')
+    parser.add_argument('--journal-sync-interval', type=float, default=0.05, help='Group commit interval in seconds for fsync of the event journal')
+    parser.add_argument('--disable-snapshot', action='store_true', help='Do not keep the local snapshot index used to find changes made while stopped')
+    parser.add_argument('--scan-workers', type=int, default=8, help='Threads listing directories when registering watches and diffing the tree against the snapshot index')
+    parser.add_argument('--journal-compact-bytes', type=int, default=64 * 1024 * 1024, help='Compact the event journal once this many bytes of it are acknowledged (0 to compact on queue reset only)')
+    parser.add_argument('--disable-journal', action='store_true', help='Do not journal events to the queue file')
+    parser.add_argument('--record-trace', type=str, default=None, metavar='FILE', help='Append the watcher event stream to a gzipped trace for scripts/inotify-replay-benchmark.py')
+    parser.add_argument('--server-idle-timeout', type=float, default=30, help='Seconds of silence after which a busy csync2 server is considered idle')
+    parser.add_argument('--retry-max-attempts', type=int, default=5, help='Failed attempts per path and node before it is written to the dead-letter file')
+    parser.add_argument('--retry-base-delay', type=float, default=2.0, help='Backoff before the first retry of a failed path, doubled on every attempt')
+    parser.add_argument('--retry-max-delay', type=float, default=300, help='Maximum backoff between retries of a failed path')
+    parser.add_argument('--max-node-lag', type=int, default=8, help='Checked batches a node may fall behind before new checks wait for it')
+    parser.add_argument('--node-retry-delay', type=float, default=5, help='Seconds before a failed node push is retried')
+    parser.add_argument('--parallel-updates', type=int, default=4, help='Maximum concurrent csync2/rsync subprocesses across all nodes (0 for no limit)')
+    parser.add_argument('--per-node-updates', type=int, default=1, help='Maximum concurrent csync2/rsync subprocesses per node (0 for no limit)')
+    parser.add_argument('--max-wait-time', type=float, default=10, help='Maximum time the oldest pending change waits before processing queue')
+    parser.add_argument('--min-quiet-time', type=float, default=0.05, help='Quiet period before a flush when events are rare')
+    parser.add_argument('--max-quiet-time', type=float, default=2.0, help='Quiet period before a flush during sustained event bursts')
+    parser.add_argument('--max-pending', type=int, default=10000, help='Flush as soon as this many coalesced paths are pending')
+    parser.add_argument('--rate-window', type=float, default=1.0, help='Time constant in seconds of the event rate average driving the quiet period')
     parser.add_argument('-m', '--mode', choices=['async', 'thread'], default='async', help='Execution mode (async or thread)')
+    parser.add_argument('--backend', choices=['native', 'pyinotify', 'fanotify'], default='native', help='Watcher backend (native batched inotify reader, pyinotify, or fanotify filesystem marks)')
+    parser.add_argument('--max-watches', type=int, default=0, help='Inotify watches to use before directories are polled instead (0 for 90%% of fs.inotify.max_user_watches)')
+    parser.add_argument('--cold-poll-interval', type=float, default=60, help='Seconds between polls of directories without an inotify watch')
+    parser.add_argument('--native-read-size', type=int, default=256 * 1024, help='Buffer size in bytes for each native inotify read')
+    parser.add_argument('--rsync-mode', choices=['files', 'tree'], default='files', help='Transfer exactly the changed paths of a large batch (files) or rsync the whole include roots (tree)')
+    parser.add_argument('--rsync-options', type=str, default='', help='Extra rsync options for all nodes, e.g. --rsync-options="-z --bwlimit=50m"')
+    parser.add_argument('--rsync-node-options', action='append', default=[], metavar='NODE=OPTIONS', help='rsync options for one node, replacing --rsync-options (repeatable)')
+    parser.add_argument('--ssh-command', type=str, default='ssh', help='Command used as SSH transport for rsync and the connection pool')
+    parser.add_argument('--ssh-idle-timeout', type=float, default=600, help='Seconds after which an unused SSH master connection is closed')
+    parser.add_argument('--disable-ssh-pool', action='store_true', help='Let every rsync open its own SSH connection')
     parser.add_argument('--disable-rsync', action='store_true', help='Disable the use of rsync for large batches')
+    parser.add_argument('--latency-report-interval', type=float, default=60, help='Seconds between log lines with event to replication latency percentiles (0 to disable)')
+    parser.add_argument('--metrics-listen', type=str, default='', metavar='ADDRESS', help='Serve OpenMetrics on HOST:PORT or unix:PATH (disabled by default)')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
     args, csync_opts = parser.parse_known_args()
 
@@ -490,12 +3732,50 @@ if __name__ == "__main__":
     config_file = args.config
     check_interval = args.check_interval
     full_sync_interval = args.full_sync_interval
+    full_sync_budget = args.full_sync_budget
+    shard_files = args.shard_files
     num_lines_until_reset = args.num_lines_until_reset
     num_batched_changes_threshold = args.num_batched_changes_threshold
     rsync_threshold = args.rsync_threshold
+    collapse_min_children = args.collapse_min_children
+    collapse_ratio = args.collapse_ratio
+    max_argv_bytes = args.max_argv_bytes
+    use_journal = not args.disable_journal
+    use_snapshot = not args.disable_snapshot
+    scan_workers = args.scan_workers
+    journal_sync_interval = args.journal_sync_interval
+    journal_compact_bytes = args.journal_compact_bytes
+    server_idle_timeout = args.server_idle_timeout
+    retry_max_attempts = args.retry_max_attempts
+    retry_base_delay = args.retry_base_delay
+    retry_max_delay = args.retry_max_delay
+    max_node_lag = args.max_node_lag
+    node_retry_delay = args.node_retry_delay
     parallel_updates = args.parallel_updates
+    per_node_updates = args.per_node_updates
     max_wait_time = args.max_wait_time
+    min_quiet_time = args.min_quiet_time
+    max_quiet_time = args.max_quiet_time
+    max_pending = args.max_pending
+    rate_window = args.rate_window
     use_rsync = not args.disable_rsync
+    rsync_mode = args.rsync_mode
+    ssh_command = shlex.split(args.ssh_command)
+    ssh_idle_timeout = args.ssh_idle_timeout
+    use_ssh_pool = not args.disable_ssh_pool
+    trace_file = args.record_trace
+    metrics_listen = args.metrics_listen
+    latency_report_interval = args.latency_report_interval
+    rsync_options = shlex.split(args.rsync_options)
+    for spec in args.rsync_node_options:
+        node, sep, options = spec.partition('=')
+        if not sep:
+            parser.error(f"--rsync-node-options expects NODE=OPTIONS, got {spec!r}")
+        rsync_node_options[node] = shlex.split(options)
+    watcher_backend = args.backend
+    max_watches = args.max_watches
+    cold_poll_interval = args.cold_poll_interval
+    native_read_size = args.native_read_size
 
     try:
         initialize_environment()
@@ -23,7 +23,7 @@ check_interval = 0.5
 full_sync_interval = 3600
 num_lines_until_reset = 200000
 num_batched_changes_threshold = 15000
-parallel_updates = 1
+parallel_updates = 4
 max_wait_time = 10  # seconds
 last_full_sync = 0
 queue_line_pos = 1
@@ -64,6 +64,21 @@ def csync_server_wait(csync_log_file):
 def update_node(node, csync_opts):
     subprocess.run(["csync2"] + csync_opts + ["-ub", "-P", node], check=True)
 
+def update_nodes(csync_opts, nodes):
+    # At most parallel_updates pushes run at once; the time each node's push
+    # waited for a free worker is logged to help tune the limit
+    submitted = time.time()
+
+    def run(node):
+        waited = time.time() - submitted
+        if waited >= 0.01:
+            logger.info(f"  {node} waited {waited:.2f}s for an update slot")
+        update_node(node, csync_opts)
+
+    workers = min(len(nodes), parallel_updates or len(nodes))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        executor.map(run, nodes)
+
 def csync_full_sync(csync_opts, includes, nodes):
     global last_full_sync
     logger.info("* FULL SYNC")
@@ -72,8 +87,7 @@ def csync_full_sync(csync_opts, includes, nodes):
 
     subprocess.run(["csync2"] + csync_opts + ["-cr"] + includes, check=True)
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-        executor.map(lambda node: update_node(node, csync_opts), nodes)
+    update_nodes(csync_opts, nodes)
 
     last_full_sync = time.time()
     logger.info("  Done")
@@ -89,19 +103,21 @@ def process_changes(csync_opts, includes, nodes, csync_files):
 
     subprocess.run(["csync2"] + csync_opts + ["-cr"] + csync_files, check=True)
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as executor:
-        executor.map(lambda node: update_node(node, csync_opts), nodes)
+    update_nodes(csync_opts, nodes)
 
     logger.info("  Done")
 
-def process_queue(queue, csync_opts, includes, nodes):
+def process_queue(event_queue, csync_opts, includes, nodes):
     global queue_line_pos, last_full_sync
     last_process_time = time.time()
     pending_files = set()
 
     while True:
         try:
-            file_path = queue.get(timeout=min(check_interval, max_wait_time - (time.time() - last_process_time)))
+            timeout = check_interval
+            if pending_files:
+                timeout = max(min(timeout, max_wait_time - (time.time() - last_process_time)), 0)
+            file_path = event_queue.get(timeout=timeout)
             pending_files.add(file_path)
         except queue.Empty:
             if time.time() - last_process_time >= max_wait_time and pending_files:
@@ -183,7 +199,7 @@ if __name__ == "__main__":
     parser.add_argument('--full-sync-interval', type=int, default=3600, help='Interval between full syncs')
     parser.add_argument('--num-lines-until-reset', type=int, default=200000, help='Number of lines until queue reset')
     parser.add_argument('--num-batched-changes-threshold', type=int, default=15000, help='Threshold for batch processing')
-    parser.add_argument('--parallel-updates', type=int, default=1, help='Enable parallel updates')
+    parser.add_argument('--parallel-updates', type=int, default=4, help='Maximum concurrent node updates (0 for no limit)')
     parser.add_argument('--max-wait-time', type=int, default=10, help='Maximum wait time before processing queue')
     args, csync_opts = parser.parse_known_args()
 
@@ -0,0 +1,36 @@
+import importlib.util
+import os
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'inotify_sync_asyncio.py')
+
+spec = importlib.util.spec_from_file_location('inotify_sync_asyncio', SCRIPT)
+inotify_sync = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(inotify_sync)
+
+
+def test_render_mixed_status_types():
+    # Return codes and "error" end up in the same series
+    registry = inotify_sync.MetricsRegistry()
+    registry.declare('csync_checks', 'counter', 'csync2 -cr runs')
+    registry.declare('csync_check_seconds', 'histogram', 'csync2 -cr duration', inotify_sync.DURATION_BUCKETS)
+    registry.inc('csync_checks', status=0)
+    registry.inc('csync_checks', status="error")
+    registry.inc('csync_checks', status=1)
+    registry.observe('csync_check_seconds', 0.2, status=0)
+    registry.observe('csync_check_seconds', 0.3, status="error")
+
+    text = registry.render()
+
+    assert 'csync_checks_total{status="0"} 1' in text
+    assert 'csync_checks_total{status="1"} 1' in text
+    assert 'csync_checks_total{status="error"} 1' in text
+    assert 'csync_check_seconds_count{status="error"} 1' in text
+    assert text.endswith("# EOF\n")
+
+
+def test_int_and_str_labels_share_a_series():
+    registry = inotify_sync.MetricsRegistry()
+    registry.declare('csync_pushes', 'counter', 'pushes')
+    registry.inc('csync_pushes', node="n1", status=0)
+    registry.inc('csync_pushes', node="n1", status="0")
+    assert registry.get('csync_pushes', node="n1", status=0) == 2